@@ -41,9 +41,10 @@ class Mxnet_model_interf:
 
 def keras_model_interf(model_file):
     import tensorflow as tf
+    from data import keras_model_infer
 
     mm = tf.keras.models.load_model(model_file, compile=False)
-    return lambda imgs: mm((tf.cast(imgs, "float32") - 127.5) * 0.0078125).numpy()
+    return keras_model_infer(mm)
 
 
 def face_align_landmark(img, landmark, image_size=(112, 112), method="similar"):
@@ -1,55 +1,466 @@
 import os
+import sys
+import json
+import time
+import atexit
+import subprocess
+import mmap
+import hashlib
 import glob2
+import fnmatch
 import numpy as np
-import pandas as pd
 import tensorflow as tf
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 # /datasets/faces_emore_112x112_folders/*/*.jpg'
 default_image_names_reg = "*/*.jpg"
 default_image_classes_rule = lambda path: int(os.path.basename(os.path.dirname(path)))
+tfrecord_meta_file = "tfrecord_meta.json"
+manifest_meta_file = "manifest.json"
+manifest_scan_dirs_file = "scan_dirs.json"
+class_frequency_sampler_powers = {"balanced": 0.0, "sqrt": 0.5}
 
 
-def pre_process_folder(data_path, image_names_reg=None, image_classes_rule=None):
+def scan_folder_images(data_path, file_pattern="*.jpg", workers=16, previous_manifest=None):
+    """ Scan class folders in a thread pool. If `previous_manifest` provided, only folders with changed mtime are rescanned """
+    with os.scandir(data_path) as it:
+        # Hidden ones like `.ipynb_checkpoints` are skipped, same as glob
+        class_dirs = {ee.path: ee.stat().st_mtime_ns for ee in it if not ee.name.startswith(".") and ee.is_dir()}
+
+    previous_dirs, previous_names = {}, {}
+    if previous_manifest is not None and os.path.exists(os.path.join(previous_manifest, manifest_scan_dirs_file)):
+        with open(os.path.join(previous_manifest, manifest_scan_dirs_file), "r") as ff:
+            previous_dirs = json.load(ff)
+        for name in load_manifest(previous_manifest)[0]:
+            previous_names.setdefault(os.path.dirname(name), []).append(name)
+    unchanged_dirs = [dd for dd, mtime in class_dirs.items() if previous_dirs.get(dd, None) == mtime]
+    changed_dirs = [dd for dd, mtime in class_dirs.items() if previous_dirs.get(dd, None) != mtime]
+    print(">>>> Class folders: %d, unchanged: %d, scanning: %d" % (len(class_dirs), len(unchanged_dirs), len(changed_dirs)))
+
+    def scan_single_folder(folder):
+        with os.scandir(folder) as it:
+            return [ee.path for ee in it if not ee.name.startswith(".") and fnmatch.fnmatch(ee.name, file_pattern) and ee.is_file()]
+
+    image_names = [name for dd in unchanged_dirs for name in previous_names.get(dd, [])]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for names in tqdm(executor.map(scan_single_folder, changed_dirs), "Scanning", total=len(changed_dirs)):
+            image_names.extend(names)
+    return image_names, class_dirs
+
+
+def pre_process_folder(data_path, image_names_reg=None, image_classes_rule=None, refresh=False):
     while data_path.endswith("/"):
         data_path = data_path[:-1]
+    if is_manifest(data_path):
+        image_names, image_classes, embeddings, classes = load_manifest(data_path)
+        return image_names, image_classes, embeddings, classes, data_path
+
     if not data_path.endswith(".npz"):
         dest_pickle = os.path.join("./", os.path.basename(data_path) + "_shuffle.npz")
+        dest_manifest = os.path.join("./", os.path.basename(data_path) + "_shuffle_manifest")
+        if refresh and os.path.exists(dest_pickle) and os.path.exists(data_path):
+            # Legacy npz has no folder mtime info, migrate to a fully rescanned manifest. npz is kept as `.bak`
+            print(">>>> refresh=True with legacy %s, rescan all into manifest, npz moved to %s.bak" % (dest_pickle, dest_pickle))
+            os.replace(dest_pickle, dest_pickle + ".bak")
+        if not os.path.exists(dest_pickle):
+            # Previous saved `_shuffle.npz` is still used if exists, new ones are saved as manifest.
+            # refresh=True rescans only class folders changed since the manifest was saved.
+            if refresh or not is_manifest(dest_manifest):
+                if not os.path.exists(data_path):
+                    return [], [], [], 0, None
+                if image_names_reg is None or image_classes_rule is None:
+                    image_names_reg, image_classes_rule = default_image_names_reg, default_image_classes_rule
+                dir_pattern, _, file_pattern = image_names_reg.partition("/")
+                if dir_pattern == "*" and len(file_pattern) != 0 and "/" not in file_pattern and "**" not in file_pattern:
+                    previous_manifest = dest_manifest if refresh and is_manifest(dest_manifest) else None
+                    image_names, scan_dirs = scan_folder_images(data_path, file_pattern, previous_manifest=previous_manifest)
+                else:
+                    image_names, scan_dirs = glob2.glob(os.path.join(data_path, image_names_reg)), None
+                image_names = np.random.permutation(image_names).tolist()
+                image_classes = [image_classes_rule(ii) for ii in image_names]
+                save_manifest(dest_manifest, image_names, image_classes, scan_dirs=scan_dirs)
+            image_names, image_classes, embeddings, classes = load_manifest(dest_manifest)
+            return image_names, image_classes, embeddings, classes, dest_manifest
     else:
         dest_pickle = data_path
 
-    if os.path.exists(dest_pickle):
-        aa = np.load(dest_pickle)
-        # with open(dest_pickle, "rb") as ff:
-        #     aa = pickle.load(ff)
-        if len(aa.keys()) == 2:
-            image_names, image_classes, embeddings = aa["image_names"], aa["image_classes"], []
-        else:
-            # dataset with embedding values
-            image_names, image_classes, embeddings = aa["image_names"], aa["image_classes"], aa["embeddings"]
+    aa = np.load(dest_pickle)
+    # with open(dest_pickle, "rb") as ff:
+    #     aa = pickle.load(ff)
+    if len(aa.keys()) == 2:
+        image_names, image_classes, embeddings = aa["image_names"], aa["image_classes"], []
     else:
-        if not os.path.exists(data_path):
-            return [], [], [], 0, None
-        if image_names_reg is None or image_classes_rule is None:
-            image_names_reg, image_classes_rule = default_image_names_reg, default_image_classes_rule
-        image_names = glob2.glob(os.path.join(data_path, image_names_reg))
-        image_names = np.random.permutation(image_names).tolist()
-        image_classes = [image_classes_rule(ii) for ii in image_names]
-        embeddings = []
-        np.savez_compressed(dest_pickle, image_names=image_names, image_classes=image_classes)
-        # with open(dest_pickle, "wb") as ff:
-        #     pickle.dump({"image_names": image_names, "image_classes": image_classes}, ff)
+        # dataset with embedding values
+        image_names, image_classes, embeddings = aa["image_names"], aa["image_classes"], aa["embeddings"]
     classes = np.max(image_classes) + 1
     return image_names, image_classes, embeddings, classes, dest_pickle
 
 
-def tf_imread(file_path):
-    img = tf.io.read_file(file_path)
+class Manifest_image_names:
+    """ Image names in a manifest, a shared path prefix + relative names in one bytes table sliced by offsets.
+    Names are only created when indexing, `np.array(image_names)` creates all of them.
+    """
+
+    def __init__(self, prefix, names_table, name_offsets):
+        self.prefix, self.names_table, self.name_offsets = prefix, names_table, name_offsets
+        self.__tf_table__ = None
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            # Same indexing as a numpy array, negative ones from the end
+            if index < -len(self) or index >= len(self):
+                raise IndexError("index %d is out of bounds for image_names with size %d" % (index, len(self)))
+            index = int(index) + len(self) if index < 0 else int(index)
+            start, end = self.name_offsets[index], self.name_offsets[index + 1]
+            return self.prefix + bytes(self.names_table[start:end]).decode()
+        if isinstance(index, slice):
+            index = range(len(self))[index]
+        elif np.asarray(index).dtype == bool:
+            index = np.nonzero(index)[0]
+        # Only the indexed names are created
+        return np.array([self[ii] for ii in index])
+
+    def __iter__(self):
+        return (self[ii] for ii in range(len(self)))
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype=dtype)
+
+    def tf_gather(self, index):
+        # Tables are copied once into graph constants, host memory is about names_table + name_offsets size.
+        # Not gathering from memmap by numpy_function, which costs a Python call per batch and can't run in tf.data service
+        if self.__tf_table__ is None:
+            self.__tf_table__ = (tf.constant(self.names_table.tobytes()), tf.constant(self.name_offsets))
+        names_table, name_offsets = self.__tf_table__
+        start, end = tf.gather(name_offsets, index), tf.gather(name_offsets, index + 1)
+        return self.prefix + tf.strings.substr(names_table, start, end - start)
+
+
+class Decoded_image_cache:
+    """ Persistent cache of decoded uint8 images in memmap `images.npy`, indexed by dataset position, filled on first read.
+    If `max_gb` is smaller than the dataset, positions are mapped to cache slots by a fixed seeded permutation, and only
+    those with a slot < max_images are cached, a random subset also for sources in identity order like MXnet record.
+    `fingerprint` identifies the position order, cache is rebuilt if it changes, like a re-shuffled manifest.
+    """
+
+    def __init__(self, cache_dir, total, img_shape=(112, 112), max_gb=None, source=None, fingerprint=None, subset_seed=0):
+        self.shape = (*img_shape[:2], 3)
+        max_images = total if max_gb is None else int(max_gb * 1024 ** 3 // np.prod(self.shape))
+        self.max_images, self.total, self.subset_seed = min(total, max_images), total, subset_seed
+        meta = {"total": int(total), "shape": list(self.shape), "max_images": self.max_images, "source": source}
+        meta.update({"fingerprint": fingerprint, "subset_seed": subset_seed})
+        meta_path = os.path.join(cache_dir, "cache_meta.json")
+        images_path, filled_path = os.path.join(cache_dir, "images.npy"), os.path.join(cache_dir, "filled.npy")
+
+        saved_meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as ff:
+                saved_meta = json.load(ff)
+        if saved_meta == meta:
+            self.images = np.load(images_path, mmap_mode="r+")
+            self.filled = np.load(filled_path, mmap_mode="r+")
+        else:
+            # Sparse files, disk space is only taken when filled
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            self.images = np.lib.format.open_memmap(images_path, mode="w+", dtype="uint8", shape=(self.max_images, *self.shape))
+            self.filled = np.lib.format.open_memmap(filled_path, mode="w+", dtype="uint8", shape=(self.max_images,))
+            with open(meta_path, "w") as ff:
+                json.dump(meta, ff)
+        print(">>>> Decoded image cache: %s, cached: %d / %d" % (cache_dir, self.filled.sum(), self.max_images))
+
+    def read(self, index):
+        return self.images[index], self.filled[index] == 1
+
+    def write(self, index, image):
+        self.images[index] = image
+        self.filled[index] = 1  # Set after image data
+        return image
+
+    def tf_decode(self, index, decode_func):
+        """ decode_func returns uint8 image in self.shape, only called if index is not cached yet """
+        index = tf.cast(index, tf.int64)
+        slot = index if self.max_images == self.total else feistel_permute(index, self.total, self.subset_seed)
+
+        def cached_decode():
+            image, is_filled = tf.numpy_function(self.read, [slot], [tf.uint8, tf.bool])
+            write_func = lambda: tf.numpy_function(self.write, [slot, decode_func(index)], tf.uint8)
+            image = tf.cond(tf.ensure_shape(is_filled, []), lambda: image, write_func)
+            return tf.ensure_shape(image, self.shape)
+
+        return tf.cond(slot < self.max_images, cached_decode, lambda: tf.ensure_shape(decode_func(index), self.shape))
+
+
+def image_source_fingerprint(data_path, image_classes, image_names_reg=None, image_classes_rule=None):
+    """ md5 of image names and classes in dataset position order, changes if positions are re-shuffled, like a rebuilt manifest.
+    For MXnet record, names are the record order, so it's `train.idx` size and mtime instead.
+    """
+    md5 = hashlib.md5(np.ascontiguousarray(image_classes, dtype="int32").tobytes())
+    if is_mxnet_record(data_path):
+        idx_path = os.path.splitext(data_path)[0] + ".idx" if data_path.endswith(".rec") else os.path.join(data_path, "train.idx")
+        md5.update(("%d_%d" % (os.stat(idx_path).st_size, os.stat(idx_path).st_mtime_ns)).encode())
+        return md5.hexdigest()
+
+    image_names = pre_process_folder(data_path, image_names_reg, image_classes_rule)[0]  # Loading saved manifest or npz
+    if isinstance(image_names, Manifest_image_names):
+        md5.update(np.ascontiguousarray(image_names.name_offsets).tobytes())
+        md5.update(np.ascontiguousarray(image_names.names_table).tobytes())
+    else:
+        md5.update("\n".join([ii.decode() if isinstance(ii, bytes) else str(ii) for ii in image_names]).encode())
+    return md5.hexdigest()
+
+
+def is_manifest(data_path):
+    return os.path.isdir(data_path) and os.path.exists(os.path.join(data_path, manifest_meta_file))
+
+
+def save_manifest(dest_dir, image_names, image_classes, embeddings=[], scan_dirs=None):
+    image_names = [ii.decode() if isinstance(ii, bytes) else str(ii) for ii in image_names]
+    prefix = os.path.commonprefix(image_names) if len(image_names) > 0 else ""
+    prefix = prefix[: prefix.rfind(os.path.sep) + 1]
+    relative_names = [ii[len(prefix) :].encode() for ii in image_names]
+    name_offsets = np.zeros([len(relative_names) + 1], dtype="int64")
+    name_offsets[1:] = np.cumsum([len(ii) for ii in relative_names])
+    image_classes = np.array(image_classes, dtype="int32")
+
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    if is_manifest(dest_dir):
+        # Overwriting, invalidate it first
+        os.remove(os.path.join(dest_dir, manifest_meta_file))
+    if scan_dirs is not None:
+        with open(os.path.join(dest_dir, manifest_scan_dirs_file), "w") as ff:
+            json.dump(scan_dirs, ff)
+    elif os.path.exists(os.path.join(dest_dir, manifest_scan_dirs_file)):
+        os.remove(os.path.join(dest_dir, manifest_scan_dirs_file))
+    np.save(os.path.join(dest_dir, "names_table.npy"), np.frombuffer(b"".join(relative_names), dtype="uint8"))
+    np.save(os.path.join(dest_dir, "name_offsets.npy"), name_offsets)
+    np.save(os.path.join(dest_dir, "image_classes.npy"), image_classes)
+    emb_shape = 0 if len(embeddings) == 0 else int(np.shape(embeddings)[-1])
+    if emb_shape != 0:
+        np.save(os.path.join(dest_dir, "embeddings.npy"), np.asarray(embeddings))
+    meta = {"prefix": prefix, "total": len(image_names), "classes": int(np.max(image_classes)) + 1, "emb_shape": emb_shape}
+    # Write meta at last, a manifest without meta file is not a valid one
+    with open(os.path.join(dest_dir, manifest_meta_file), "w") as ff:
+        json.dump(meta, ff)
+    return dest_dir
+
+
+def load_manifest(dest_dir):
+    with open(os.path.join(dest_dir, manifest_meta_file), "r") as ff:
+        meta = json.load(ff)
+    load_mmap = lambda name: np.load(os.path.join(dest_dir, name), mmap_mode="r")
+    image_names = Manifest_image_names(meta["prefix"], load_mmap("names_table.npy"), load_mmap("name_offsets.npy"))
+    image_classes = load_mmap("image_classes.npy")
+    embeddings = load_mmap("embeddings.npy") if meta["emb_shape"] != 0 else []
+    return image_names, image_classes, embeddings, meta["classes"]
+
+
+def pre_process_image_source(data_path, image_names_reg=None, image_classes_rule=None):
+    """ Return positions, image_classes, embeddings, classes, read_func. positions are `np.arange(total)` for all sources,
+    and `read_func` reads jpeg bytes by position tensor, so pipelines only carry int positions.
+    """
+    if is_mxnet_record(data_path):
+        reader = MXnet_record_reader(data_path)
+        return np.arange(len(reader)), reader.image_classes, [], reader.classes, reader.tf_read
+
+    image_names, image_classes, embeddings, classes, _ = pre_process_folder(data_path, image_names_reg, image_classes_rule)
+    if isinstance(image_names, Manifest_image_names):
+        read_func = lambda index: tf.io.read_file(image_names.tf_gather(index))
+    elif len(image_names) != 0:
+        # Legacy npz, names as a string table
+        names_table = tf.constant(np.array(image_names))
+        read_func = lambda index: tf.io.read_file(tf.gather(names_table, index))
+    else:
+        read_func = None
+    return np.arange(len(image_names)), image_classes, embeddings, classes, read_func
+
+
+def folder_to_tfrecords(data_path, save_dir=None, image_names_reg=None, image_classes_rule=None, images_per_shard=10000):
+    """ Pack `pre_process_folder` output into fixed size tfrecord shards, reading them is bulk sequential IO """
+    image_names, image_classes, embeddings, classes, dest_pickle = pre_process_folder(data_path, image_names_reg, image_classes_rule)
+    if len(image_names) == 0:
+        print(">>>> Nothing to convert in %s" % data_path)
+        return None
+    if save_dir is None:
+        src_name = os.path.splitext(os.path.basename(dest_pickle))[0]
+        src_name = src_name[: -len("_manifest")] if src_name.endswith("_manifest") else src_name
+        save_dir = src_name + "_tfrecords"
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    emb_shape = 0 if len(embeddings) == 0 else int(np.shape(embeddings)[-1])
+    bytes_feature = lambda value: tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+    int64_feature = lambda value: tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+    float_feature = lambda value: tf.train.Feature(float_list=tf.train.FloatList(value=value))
+
+    total = len(image_names)
+    total_shards = int(np.ceil(total / images_per_shard))
+    print(">>>> Image length: %d, shards: %d, save_dir: %s" % (total, total_shards, save_dir))
+    for shard_id in tqdm(range(total_shards), "Writing shards"):
+        shard_path = os.path.join(save_dir, "train-%05d-of-%05d.tfrecord" % (shard_id, total_shards))
+        with tf.io.TFRecordWriter(shard_path) as writer:
+            for ii in range(shard_id * images_per_shard, min((shard_id + 1) * images_per_shard, total)):
+                with open(image_names[ii], "rb") as ff:
+                    feature = {"image_raw": bytes_feature(ff.read()), "label": int64_feature(int(image_classes[ii]))}
+                if emb_shape != 0:
+                    feature["embedding"] = float_feature(embeddings[ii])
+                writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+
+    meta = {"total": total, "classes": int(classes), "emb_shape": emb_shape, "images_per_shard": images_per_shard}
+    with open(os.path.join(save_dir, tfrecord_meta_file), "w") as ff:
+        json.dump(meta, ff)
+    return save_dir
+
+
+def is_tfrecord_dir(data_path):
+    return os.path.isdir(data_path) and os.path.exists(os.path.join(data_path, tfrecord_meta_file))
+
+
+def tfrecords_dataset(data_path, shuffle_buffer_size=None):
+    with open(os.path.join(data_path, tfrecord_meta_file), "r") as ff:
+        meta = json.load(ff)
+    emb_shape = meta["emb_shape"]
+    features = {"image_raw": tf.io.FixedLenFeature([], tf.string), "label": tf.io.FixedLenFeature([], tf.int64)}
+    if emb_shape != 0:
+        features["embedding"] = tf.io.FixedLenFeature([emb_shape], tf.float32)
+
+    def parse_func(record):
+        example = tf.io.parse_single_example(record, features)
+        image_raw, label = example["image_raw"], tf.cast(example["label"], tf.int32)
+        return (image_raw, label) if emb_shape == 0 else (image_raw, label, example["embedding"])
+
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+    shard_files = tf.io.gfile.glob(os.path.join(data_path, "*.tfrecord"))
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+    ds = tf.data.Dataset.from_tensor_slices(shard_files).shuffle(len(shard_files))
+    ds = ds.interleave(tf.data.TFRecordDataset, cycle_length=min(16, len(shard_files)), num_parallel_calls=AUTOTUNE)
+    ds = ds.with_options(options)
+    # Shards are written from the already shuffled image list, shuffle on shard level + a buffer is enough
+    ds = ds.shuffle(buffer_size=shuffle_buffer_size or meta["images_per_shard"])
+    ds = ds.map(parse_func, num_parallel_calls=AUTOTUNE)
+    return ds, meta["total"], meta["classes"], emb_shape
+
+
+class MXnet_record_reader:
+    """ Memory mapped reader for MXnet `train.rec` / `train.idx`, reading image bytes directly without mxnet.
+    Record layout: [uint32 magic, uint32 lrecord, IRHeader(uint32 flag, float32 label, uint64 id, uint64 id2),
+    float32 * flag labels if flag > 0, image bytes], and `train.idx` lines are `key\toffset`.
+    """
+
+    def __init__(self, data_path):
+        if data_path.endswith(".rec"):
+            rec_path, idx_path = data_path, os.path.splitext(data_path)[0] + ".idx"
+        else:
+            rec_path, idx_path = os.path.join(data_path, "train.rec"), os.path.join(data_path, "train.idx")
+        with open(rec_path, "rb") as ff:
+            self.mm = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Parsed headers are cached next to train.idx, keyed by its mtime and rec size, skipping millions of random reads
+        cache_path = os.path.splitext(idx_path)[0] + "_headers_cache.npz"
+        cache_key = np.array([os.stat(idx_path).st_mtime_ns, os.stat(rec_path).st_size], dtype="int64")
+        cached = np.load(cache_path) if os.path.exists(cache_path) else None
+        if cached is not None and np.array_equal(cached["cache_key"], cache_key):
+            self.keys, self.image_starts, self.image_lens = cached["keys"], cached["image_starts"], cached["image_lens"]
+            self.image_classes = cached["image_classes"]
+        else:
+            self.__parse_headers__(idx_path)
+            try:
+                arrays = {"cache_key": cache_key, "keys": self.keys, "image_starts": self.image_starts}
+                arrays.update({"image_lens": self.image_lens, "image_classes": self.image_classes})
+                with open(cache_path + ".tmp", "wb") as ff:
+                    np.savez(ff, **arrays)
+                os.replace(cache_path + ".tmp", cache_path)
+            except OSError as ee:
+                print(">>>> Saving MXnet record headers cache failed: %s" % ee)
+        self.classes = int(np.max(self.image_classes)) + 1 if len(self.keys) > 0 else 0
+
+    def __parse_headers__(self, idx_path):
+        idx = np.fromfile(idx_path, dtype=np.int64, sep=" ").reshape(-1, 2)
+        idx = idx[np.argsort(idx[:, 0])]
+        keys, offsets = idx[:, 0], idx[:, 1]
+        buf = np.frombuffer(self.mm, dtype=np.uint8)
+        read_scalar = lambda pos, dtype: buf[pos[:, None] + np.arange(4)].copy().view(dtype)[:, 0]
+
+        flags = read_scalar(offsets + 8, "<u4")
+        if keys[0] == 0 and flags[0] > 0:
+            # Insightface header record, label[0] is the first identity record index, images are [1, label[0])
+            images_end = int(read_scalar(offsets[:1] + 32, "<f4")[0])
+            is_image = np.logical_and(keys >= 1, keys < images_end)
+            keys, offsets, flags = keys[is_image], offsets[is_image], flags[is_image]
+
+        lrecord = read_scalar(offsets + 4, "<u4") & ((1 << 29) - 1)
+        labels = np.where(flags > 0, read_scalar(offsets + 32, "<f4"), read_scalar(offsets + 12, "<f4"))
+        header_size = 24 + 4 * flags.astype("int64")
+        self.keys = keys
+        self.image_starts = offsets + 8 + header_size
+        self.image_lens = lrecord.astype("int64") - header_size
+        self.image_classes = labels.astype("int32")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def read(self, index):
+        start = self.image_starts[index]
+        return bytes(memoryview(self.mm)[start : start + self.image_lens[index]])
+
+    def tf_read(self, index):
+        img = tf.numpy_function(self.read, [index], tf.string)
+        return tf.ensure_shape(img, ())
+
+    def tf_imread(self, index):
+        return tf_imdecode(self.tf_read(index))
+
+
+def is_mxnet_record(data_path):
+    if data_path.endswith(".rec"):
+        return os.path.exists(data_path)
+    return os.path.exists(os.path.join(data_path, "train.rec")) and os.path.exists(os.path.join(data_path, "train.idx"))
+
+
+def tf_imdecode(img):
     img = tf.image.decode_jpeg(img, channels=3)  # [0, 255]
     # img = tf.image.convert_image_dtype(img, tf.float32)  # [0, 1]
     img = tf.cast(img, "float32")  # [0, 255]
     return img
 
 
+def tf_imread(file_path):
+    return tf_imdecode(tf.io.read_file(file_path))
+
+
+def keras_model_infer(model):
+    """ Inference function on [0, 255] images for a keras basic_model, returns numpy embeddings.
+    Models built with uint8_input=True take uint8 images and do normalization themselves, others take normalized float32.
+    """
+    if model.inputs[0].dtype == tf.uint8:
+        return lambda imgs: model(tf.cast(imgs, "uint8")).numpy()
+    return lambda imgs: model((tf.cast(imgs, "float32") - 127.5) * 0.0078125).numpy()
+
+
+def tf_imdecode_random_crop(img, img_shape=(112, 112), random_crop=(100, 100, 3)):
+    """ Same with `tf.image.random_crop` + `tf.image.resize` on decoded image, but only decodes pixels in the crop window.
+    If the crop window is at least 2x larger than img_shape, decode with a reduced DCT scale `ratio`.
+    """
+    crop_hh, crop_ww = random_crop[0], random_crop[1]
+    ratio = max([rr for rr in [1, 2, 4, 8] if crop_hh // rr >= img_shape[0] and crop_ww // rr >= img_shape[1]] + [1])
+    shape = tf.image.extract_jpeg_shape(img)
+    offset_hh = tf.random.uniform([], 0, shape[0] - crop_hh + 1, dtype=tf.int32)
+    offset_ww = tf.random.uniform([], 0, shape[1] - crop_ww + 1, dtype=tf.int32)
+    # Crop window is in the scaled image coordinates if ratio > 1
+    crop_window = tf.stack([offset_hh // ratio, offset_ww // ratio, crop_hh // ratio, crop_ww // ratio])
+    img = tf.image.decode_and_crop_jpeg(img, crop_window, channels=3, ratio=ratio)
+    img = tf.cast(img, "float32")  # [0, 255]
+    return tf.image.resize(img, img_shape)
+
+
 def random_process_image(img, img_shape=(112, 112), random_status=2, random_crop=None):
     if random_status >= 0:
         img = tf.image.random_flip_left_right(img)
@@ -68,6 +479,157 @@ def random_process_image(img, img_shape=(112, 112), random_status=2, random_crop
     return img
 
 
+def random_process_image_batch(imgs, img_shape=(112, 112), random_status=2, random_crop=None):
+    """ Batch version of `random_process_image` on [batch, height, width, channel] float images.
+    Random values are sampled per image as vectors, so ops number is constant per batch.
+    """
+    batch = tf.shape(imgs)[0]
+    random_uniform = lambda low, high: tf.random.uniform([batch, 1, 1, 1], low, high)
+    if random_status >= 0:
+        imgs = tf.where(random_uniform(0.0, 1.0) < 0.5, tf.reverse(imgs, axis=[2]), imgs)
+    if random_status >= 1:
+        # 25.5 == 255 * 0.1
+        imgs = imgs + random_uniform(-25.5 * random_status, 25.5 * random_status)
+    if random_status >= 2:
+        lower, upper = 1 - 0.1 * random_status, 1 + 0.1 * random_status
+        mean = tf.reduce_mean(imgs, axis=[1, 2], keepdims=True)
+        imgs = (imgs - mean) * random_uniform(lower, upper) + mean
+        hue, saturation, value = tf.split(tf.image.rgb_to_hsv(imgs), 3, axis=-1)
+        saturation = tf.clip_by_value(saturation * random_uniform(lower, upper), 0.0, 1.0)
+        imgs = tf.image.hsv_to_rgb(tf.concat([hue, saturation, value], axis=-1))
+    if random_status >= 3 and random_crop is not None:
+        # Crop and resize all images in one op, boxes are normalized [y1, x1, y2, x2]
+        hh, ww = tf.shape(imgs)[1], tf.shape(imgs)[2]
+        offset_hh = tf.cast(tf.random.uniform([batch], 0, hh - random_crop[0] + 1, dtype=tf.int32), "float32")
+        offset_ww = tf.cast(tf.random.uniform([batch], 0, ww - random_crop[1] + 1, dtype=tf.int32), "float32")
+        scale_hh, scale_ww = tf.cast(hh - 1, "float32"), tf.cast(ww - 1, "float32")
+        y1, x1 = offset_hh / scale_hh, offset_ww / scale_ww
+        y2, x2 = (offset_hh + random_crop[0] - 1) / scale_hh, (offset_ww + random_crop[1] - 1) / scale_ww
+        boxes = tf.stack([y1, x1, y2, x2], axis=1)
+        imgs = tf.image.crop_and_resize(imgs, boxes, tf.range(batch), img_shape)
+
+    if random_status >= 1:
+        imgs = tf.clip_by_value(imgs, 0.0, 255.0)
+    return imgs
+
+
+def feistel_permute(index, total, seed=0, epoch=0, rounds=4):
+    """Map index in [0, total) to its position in a random permutation, without materializing it.
+    A keyed Feistel network on [0, 2^(2 * half_bits)) with cycle walking. Same (seed, epoch) gives the same permutation.
+    total / seed / epoch can also be tensors broadcastable to index, permuting each element in its own range.
+    """
+    index, total = tf.cast(index, tf.int64), tf.cast(total, tf.int64)
+    seed, epoch = tf.cast(seed, tf.int64), tf.cast(epoch, tf.int64)
+    log2_total = tf.math.log(tf.cast(tf.maximum(total, 2), tf.float64)) / np.log(2)
+    half_bits = tf.maximum(tf.cast(tf.math.ceil(log2_total / 2), tf.int64), 1)
+    half_mask = tf.bitwise.left_shift(tf.ones_like(half_bits), half_bits) - 1
+    mask_31 = tf.constant(0x7FFFFFFF, tf.int64)  # Keep every product within int64
+    keys = [tf.bitwise.bitwise_and(seed, mask_31) * 1000003 + epoch * 7919 + ii * 104729 for ii in range(rounds)]
+    keys = [tf.bitwise.bitwise_and(tf.bitwise.bitwise_and(kk, mask_31) * 0x5BD1E995, mask_31) for kk in keys]
+
+    def round_func(right, key):
+        xx = tf.bitwise.bitwise_and(tf.bitwise.bitwise_xor(right, key) * 0x2C1B3C6D, mask_31)
+        xx = tf.bitwise.bitwise_xor(xx, tf.bitwise.right_shift(xx, 15))
+        xx = tf.bitwise.bitwise_and(xx * 0x297A2D39, mask_31)
+        return tf.bitwise.bitwise_and(tf.bitwise.bitwise_xor(xx, tf.bitwise.right_shift(xx, 13)), half_mask)
+
+    def permute_once(xx):
+        left, right = tf.bitwise.right_shift(xx, half_bits), tf.bitwise.bitwise_and(xx, half_mask)
+        for key in keys:
+            left, right = right, tf.bitwise.bitwise_xor(left, round_func(right, key))
+        return tf.bitwise.bitwise_or(tf.bitwise.left_shift(left, half_bits), right)
+
+    # Cycle walking, re-permute values out of [0, total) till all in range. Domain is < 4 * total, so it stops fast
+    cond = lambda xx: tf.reduce_any(xx >= total)
+    body = lambda xx: [tf.where(xx >= total, permute_once(xx), xx)]
+    return tf.while_loop(cond, body, [permute_once(index)])[0]
+
+
+def permuted_index_dataset(total, seed=0, initial_sample=0, epochs=None):
+    """Dataset of (shuffled index) over a global sample counter, epoch = counter // total.
+    Full shuffle with no buffer, epochs=None for an infinite stream.
+    """
+    end = np.iinfo(np.int64).max if epochs is None else total * epochs
+    ds = tf.data.Dataset.range(initial_sample, end).batch(1024)  # Vectorized permutation on index batches
+    ds = ds.map(lambda ii: feistel_permute(ii % total, total, seed, ii // total), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.unbatch()
+
+
+def class_frequency_index_dataset(image_classes, power=0.0, seed=0, initial_sample=0):
+    """Infinite dataset of index, sampling class by probability `count ** power`, then an image uniformly in it.
+    power=0 for class balanced, 0.5 for square root frequency. Random values are stateless on the global sample counter,
+    so any position is reproducible from seed.
+    """
+    image_classes = np.asarray(image_classes)
+    class_counts = np.bincount(image_classes)
+    class_starts = np.concatenate([[0], np.cumsum(class_counts)[:-1]])
+    weights = np.where(class_counts > 0, class_counts.astype("float64") ** power, 0)
+    class_cdf = tf.constant(np.cumsum(weights) / np.sum(weights))
+    sorted_index = tf.constant(np.argsort(image_classes, kind="stable"), tf.int64)
+    class_counts, class_starts = tf.constant(class_counts, tf.int64), tf.constant(class_starts, tf.int64)
+
+    def sample_func(counter):
+        rand = tf.random.stateless_uniform([tf.shape(counter)[0], 2], seed=[seed, counter[0]], dtype=tf.float64)
+        class_id = tf.minimum(tf.searchsorted(class_cdf, rand[:, 0], side="right"), len(weights) - 1)
+        counts = tf.gather(class_counts, class_id)
+        in_class_index = tf.minimum(tf.cast(rand[:, 1] * tf.cast(counts, tf.float64), tf.int64), counts - 1)
+        return tf.gather(sorted_index, tf.gather(class_starts, class_id) + in_class_index)
+
+    # Range batches aligned to 1024, so the same counter always gets the same random values
+    aligned_start = initial_sample // 1024 * 1024
+    ds = tf.data.Dataset.range(aligned_start, np.iinfo(np.int64).max).batch(1024)
+    ds = ds.map(sample_func, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return ds.unbatch().skip(initial_sample - aligned_start)
+
+
+def data_service_worker(dispatcher_address):
+    """ Runs in a separate python process, serving dataset work for the dispatcher """
+    config = tf.data.experimental.service.WorkerConfig(dispatcher_address=dispatcher_address)
+    tf.data.experimental.service.WorkerServer(config).join()
+
+
+local_data_service = {"dispatcher": None, "workers": []}
+
+
+def init_local_data_service(num_workers):
+    """ A tf.data service dispatcher in this process, and num_workers CPU only worker processes on localhost.
+    Started once and reused by later datasets. Returns the service target for `tf.data.experimental.service.distribute`.
+    """
+    if local_data_service["dispatcher"] is None:
+        config = tf.data.experimental.service.DispatcherConfig(port=0)
+        local_data_service["dispatcher"] = tf.data.experimental.service.DispatchServer(config)
+        atexit.register(lambda: [ii.terminate() for ii in local_data_service["workers"] if ii.poll() is None])
+    dispatcher = local_data_service["dispatcher"]
+    dispatcher_address = dispatcher.target.split("://")[-1]
+
+    workers = local_data_service["workers"]
+    wait_seconds = 0
+    if len(workers) < num_workers:
+        print(">>>> Start %d data service workers, dispatcher: %s" % (num_workers - len(workers), dispatcher.target))
+        # Separate programs only importing this module, not re-running the caller script like multiprocessing spawn does
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES="-1")  # Keep GPUs for training
+        python_path = [os.path.dirname(os.path.abspath(__file__))] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+        env["PYTHONPATH"] = os.pathsep.join(python_path)
+        cmd = [sys.executable, "-c", "import data; data.data_service_worker(%r)" % dispatcher_address]
+        for _ in range(num_workers - len(workers)):
+            workers.append(subprocess.Popen(cmd, env=env))
+        wait_seconds = 60 if hasattr(dispatcher, "_num_workers") else 15
+
+    # Wait till all workers registered to dispatcher, or fail if any exited, instead of fit waiting forever with no worker
+    start_time = time.time()
+    while True:
+        dead_workers = [ii for ii in workers if ii.poll() is not None]
+        if len(dead_workers) != 0:
+            return_codes = [ii.returncode for ii in dead_workers]
+            raise RuntimeError("%d data service workers exited, return codes: %s" % (len(dead_workers), return_codes))
+        # DispatchServer._num_workers is private, only in some TF versions. Without it, just wait for worker bootstrap
+        num_registered = dispatcher._num_workers() if hasattr(dispatcher, "_num_workers") else None
+        if (num_registered is not None and num_registered >= num_workers) or time.time() - start_time >= wait_seconds:
+            break
+        time.sleep(1)
+    return dispatcher.target
+
+
 def prepare_dataset(
     data_path,
     image_names_reg=None,
@@ -77,38 +639,133 @@ def prepare_dataset(
     random_status=2,
     random_crop=None,
     cache=False,
+    cache_max_gb=None,
     shuffle_buffer_size=None,
     is_train=True,
+    sparse_label=False,
+    batch_augment=False,
+    keep_uint8=False,
+    shuffle_seed=None,
+    initial_epoch=0,
+    initial_step=0,
+    data_service_workers=0,
+    sampler="uniform",
 ):
-    image_names, image_classes, embeddings, classes, _ = pre_process_folder(data_path, image_names_reg, image_classes_rule)
-    if len(image_names) == 0:
-        return None
-    print(">>>> Image length: %d, Image class length: %d, classes: %d" % (len(image_names), len(image_classes), classes))
-
-    if len(embeddings) == 0:
-        ds = tf.data.Dataset.from_tensor_slices((image_names, image_classes))
-        process_func = lambda imm, label: (tf_imread(imm), tf.one_hot(label, depth=classes, dtype=tf.int32))
+    if sampler != "uniform" and sampler not in class_frequency_sampler_powers:
+        raise ValueError("sampler should be one of %s, got: %s" % (["uniform", *class_frequency_sampler_powers], sampler))
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+    # sparse_label=True keeps int32 class ids [batch] instead of one-hot [batch, classes] ones
+    label_func = lambda label: tf.cast(label, tf.int32) if sparse_label else tf.one_hot(label, depth=classes, dtype=tf.int32)
+    if is_tfrecord_dir(data_path):
+        # Sharded tfrecords from `folder_to_tfrecords`, image bytes already in records
+        ds, total, classes, emb_shape = tfrecords_dataset(data_path, shuffle_buffer_size)
+        print(">>>> Image length: %d, classes: %d, tfrecords: %s" % (total, classes, data_path))
+        read_func = lambda imm: imm
+        steps_per_epoch, shuffle_seed, emb_gather_func = None, None, None
     else:
-        # dataset with embedding values
-        print(">>>> embeddings: %s. This takes some time..." % (np.shape(embeddings),))
-        ds = tf.data.Dataset.from_tensor_slices((image_names, image_classes, embeddings))
-        process_func = lambda imm, label, emb: (tf_imread(imm), (tf.one_hot(label, depth=classes, dtype=tf.int32), emb))
+        # image_names are int positions, read_func reads image bytes by position
+        image_names, image_classes, embeddings, classes, read_func = pre_process_image_source(data_path, image_names_reg, image_classes_rule)
+        if len(image_names) == 0:
+            return None
+        print(">>>> Image length: %d, Image class length: %d, classes: %d" % (len(image_names), len(image_classes), classes))
 
-    AUTOTUNE = tf.data.experimental.AUTOTUNE
-    ds = ds.shuffle(buffer_size=len(image_names))
+        # Shuffle by an epoch seeded index permutation, gathering names / labels by index, instead of a full size shuffle buffer.
+        # is_train=True gives an infinite stream starting from batch `initial_step` in `initial_epoch`, use `ds.steps_per_epoch` for fit.
+        total = len(image_names)
+        steps_per_epoch = total // batch_size if is_train else None
+        initial_sample = (initial_epoch * steps_per_epoch + initial_step) * batch_size if is_train else 0
+        shuffle_seed = np.random.randint(0, 2 ** 31) if shuffle_seed is None else shuffle_seed
+        print(">>>> shuffle_seed: %d, initial_epoch: %d, initial_step: %d" % (shuffle_seed, initial_epoch, initial_step))
+        print(">>>> steps_per_epoch: %s" % steps_per_epoch)
+        if is_train and sampler in class_frequency_sampler_powers:
+            # Sampling by class frequency for long tail datasets, also `steps_per_epoch` batches for an epoch
+            print(">>>> Class frequency sampler: %s" % sampler)
+            power = class_frequency_sampler_powers[sampler]
+            ds = class_frequency_index_dataset(image_classes, power, shuffle_seed, initial_sample)
+        else:
+            ds = permuted_index_dataset(total, shuffle_seed, initial_sample, epochs=None if is_train else 1)
+        classes_table = tf.constant(np.array(image_classes))  # Copied from memmap, int32 labels, 4 bytes per image
+        emb_gather_func = None
+
+        # Elements keep the dataset position, image bytes are read by it in `decode_func`
+        if len(embeddings) == 0:
+            ds = ds.map(lambda idx: (idx, tf.gather(classes_table, idx)), num_parallel_calls=AUTOTUNE)
+        else:
+            # dataset with embedding values. Only positions are kept in pipeline, embeddings are gathered after batch,
+            # from the memmap float16 / float32 array for manifest.
+            print(">>>> embeddings: %s, dtype: %s" % (np.shape(embeddings), embeddings.dtype))
+            emb_shape = int(np.shape(embeddings)[-1])
+            take_func = lambda idx: np.asarray(embeddings[idx], dtype="float32")
+            emb_gather_func = lambda idx: tf.ensure_shape(tf.numpy_function(take_func, [idx], tf.float32), [None, emb_shape])
+            ds = ds.map(lambda idx: (idx, tf.gather(classes_table, idx), idx), num_parallel_calls=AUTOTUNE)
+
+    # cache=True or a path, decoded images are saved in a memmap file on first read, later epochs skip decoding
+    image_cache = None
+    if cache and is_tfrecord_dir(data_path):
+        print(">>>> Decoded image cache not supported for tfrecords, skip it")
+    elif cache:
+        cache_dir = cache if isinstance(cache, str) else os.path.basename(os.path.normpath(data_path)) + "_decoded_cache"
+        fingerprint = image_source_fingerprint(data_path, image_classes, image_names_reg, image_classes_rule)
+        image_cache = Decoded_image_cache(cache_dir, total, img_shape, max_gb=cache_max_gb, source=data_path, fingerprint=fingerprint)
+
+    # With random_crop, decode is delayed to `random_process_func`, which decodes only the crop window.
+    # batch_augment=True applies `random_process_image_batch` after batch instead.
+    is_fused_crop = is_train and random_status >= 3 and random_crop is not None and not batch_augment and image_cache is None
+    if image_cache is not None:
+        resize_func = lambda idx: tf.saturate_cast(tf.round(tf.image.resize(tf_imdecode(read_func(idx)), img_shape)), tf.uint8)
+        decode_func = lambda idx: tf.cast(image_cache.tf_decode(idx, resize_func), "float32")
+    elif is_fused_crop:
+        decode_func = lambda imm: read_func(imm)
+    else:
+        decode_func = lambda imm: tf_imdecode(read_func(imm))
+    if len(ds.element_spec) == 2:
+        process_func = lambda imm, label: (decode_func(imm), label_func(label))
+    else:
+        process_func = lambda imm, label, emb: (decode_func(imm), (label_func(label), emb))
     ds = ds.map(process_func, num_parallel_calls=AUTOTUNE)
 
-    if is_train and random_status >= 0:
-        random_process_func = lambda xx, yy: (random_process_image(xx, img_shape, random_status, random_crop), yy)
+    if is_train and random_status >= 0 and not batch_augment:
+        if is_fused_crop:
+            fused_crop_func = lambda xx: tf_imdecode_random_crop(xx, img_shape, random_crop)
+            random_process_func = lambda xx, yy: (random_process_image(fused_crop_func(xx), img_shape, random_status), yy)
+        else:
+            random_process_func = lambda xx, yy: (random_process_image(xx, img_shape, random_status, random_crop), yy)
         ds = ds.map(random_process_func, num_parallel_calls=AUTOTUNE)
 
+    # keep_uint8=True for models doing normalization themselves, cast back to uint8 as early as possible
+    is_batch_augment = is_train and random_status >= 0 and batch_augment
+    if keep_uint8 and not is_batch_augment:
+        ds = ds.map(lambda xx, yy: (tf.saturate_cast(tf.round(xx), tf.uint8), yy), num_parallel_calls=AUTOTUNE)
     ds = ds.batch(batch_size)  # Use batch --> map has slightly effect on dataset reading time, but harm the randomness
-    ds = ds.map(lambda xx, yy: ((xx - 127.5) * 0.0078125, yy))
+    if is_batch_augment:
+        random_process_func = lambda xx, yy: (random_process_image_batch(xx, img_shape, random_status, random_crop), yy)
+        ds = ds.map(random_process_func, num_parallel_calls=AUTOTUNE)
+    if not keep_uint8:
+        ds = ds.map(lambda xx, yy: ((xx - 127.5) * 0.0078125, yy))
+    elif is_batch_augment:
+        ds = ds.map(lambda xx, yy: (tf.saturate_cast(tf.round(xx), tf.uint8), yy))
+
+    # data_service_workers > 0, all above runs in local worker processes, each taking its split of the index stream.
+    # Python functions cannot run in workers, so not for MXnet record or dataset_cache, and embeddings are gathered after it.
+    if data_service_workers > 0 and (is_mxnet_record(data_path) or image_cache is not None):
+        print(">>>> data_service_workers not supported for MXnet record or dataset_cache, skip it")
+    elif data_service_workers > 0:
+        service = init_local_data_service(data_service_workers)
+        ds = ds.apply(tf.data.experimental.service.distribute(processing_mode="distributed_epoch", service=service))
+    if emb_gather_func is not None:
+        ds = ds.map(lambda xx, yy: (xx, (yy[0], emb_gather_func(yy[1]))), num_parallel_calls=AUTOTUNE)
     ds = ds.prefetch(buffer_size=AUTOTUNE)
+    ds.classes = classes
+    ds.steps_per_epoch, ds.shuffle_seed = steps_per_epoch, shuffle_seed
     return ds
 
 
 class Triplet_dataset:
+    """ P classes x K images batches. Each epoch, images in every class are split into groups of image_per_class images by
+    a per-class index permutation, and groups are shuffled by another one, all computed in graph from class offset arrays.
+    It's an infinite stream, use `steps_per_epoch` for fit.
+    """
+
     def __init__(
         self,
         data_path,
@@ -119,58 +776,80 @@ class Triplet_dataset:
         img_shape=(112, 112, 3),
         random_status=3,
         random_crop=None,
+        sparse_label=False,
+        keep_uint8=False,
+        shuffle_seed=None,
+        initial_epoch=0,
+        initial_step=0,
     ):
         self.AUTOTUNE = tf.data.experimental.AUTOTUNE
-        image_names, image_classes, _, classes, _ = pre_process_folder(data_path, image_names_reg, image_classes_rule)
-        image_dataframe = pd.DataFrame({"image_names": image_names, "image_classes": image_classes})
-        image_dataframe = image_dataframe.groupby("image_classes").apply(lambda xx: xx.image_names.values)
-        aa = image_dataframe.map(len)
-        self.image_dataframe = image_dataframe[aa > image_per_class]
-        self.split_func = lambda xx: np.array(
-            np.split(np.random.permutation(xx)[: len(xx) // image_per_class * image_per_class], len(xx) // image_per_class)
-        )
+        _, image_classes, _, classes, read_func = pre_process_image_source(data_path, image_names_reg, image_classes_rule)
+        # Labels are gathered from image_classes by position
+        image_classes = np.asarray(image_classes)
+        classes_table = tf.constant(image_classes.astype("int32"))
+        if sparse_label:
+            get_label = lambda idx: tf.gather(classes_table, idx)
+        else:
+            get_label = lambda idx: tf.one_hot(tf.gather(classes_table, idx), depth=classes, dtype=tf.int32)
+
+        # Positions sorted by class, class_starts / class_counts are offsets into it. Only classes with > image_per_class images
+        sorted_index = np.argsort(image_classes, kind="stable")
+        class_counts = np.bincount(image_classes, minlength=classes)
+        class_starts = np.concatenate([[0], np.cumsum(class_counts)[:-1]])
+        class_groups = np.where(class_counts > image_per_class, class_counts // image_per_class, 0)
+        # Group table, group id --> (class, group rank in class)
+        group_class = np.repeat(np.arange(classes), class_groups)
+        group_rank = np.arange(len(group_class)) - np.repeat(np.cumsum(class_groups) - class_groups, class_groups)
+        self.total_groups = len(group_class)
+
         self.image_per_class = image_per_class
         self.batch_size = batch_size
         self.img_shape = img_shape[:2]
         self.channels = img_shape[2] if len(img_shape) > 2 else 3
+        self.steps_per_epoch = self.total_groups // batch_size
+        self.shuffle_seed = np.random.randint(0, 2 ** 31) if shuffle_seed is None else shuffle_seed
         print("The final train_dataset batch will be %s" % ([batch_size * image_per_class, *self.img_shape, self.channels]))
+        print(">>>> Total groups: %d, steps_per_epoch: %d" % (self.total_groups, self.steps_per_epoch))
+        print(">>>> shuffle_seed: %d, initial_epoch: %d, initial_step: %d" % (self.shuffle_seed, initial_epoch, initial_step))
+
+        self.sorted_index, self.class_starts = tf.constant(sorted_index, tf.int64), tf.constant(class_starts, tf.int64)
+        self.class_counts = tf.constant(class_counts, tf.int64)
+        self.group_class, self.group_rank = tf.constant(group_class, tf.int64), tf.constant(group_rank, tf.int64)
 
-        get_label = lambda xx: tf.one_hot(
-            tf.cast(tf.strings.to_number(tf.strings.split(xx, os.path.sep)[-2]), tf.int32), depth=classes, dtype=tf.int32
-        )
-        self.process_path = lambda img_name: (
-            random_process_image(tf_imread(img_name), self.img_shape, random_status, random_crop),
-            get_label(img_name),
-        )
-        # image_data = self.image_data_shuffle()
-        # self.steps_per_epoch = np.ceil(image_data.shape[0] / self.batch_size)
-
-        train_dataset = tf.data.Dataset.from_generator(
-            self.image_data_shuffle_gen, output_types=tf.string, output_shapes=(image_per_class,)
-        )
-        # train_dataset = train_dataset.shuffle(total)
-        train_dataset = train_dataset.batch(self.batch_size)
-        if "-dev" in tf.__version__ or int(tf.__version__.split(".")[1]) > 2:
-            # tf-nightly or tf >= 2.3.0
-            train_dataset = train_dataset.map(self.process_batch_path_2, num_parallel_calls=self.AUTOTUNE)
+        if random_status >= 3 and random_crop is not None:
+            # Decode only the random crop window
+            imread = lambda idx: tf_imdecode_random_crop(read_func(idx), self.img_shape, random_crop)
+            random_crop = None
         else:
-            train_dataset = train_dataset.map(self.process_batch_path_1, num_parallel_calls=self.AUTOTUNE)
-        train_dataset = train_dataset.map(lambda xx, yy: ((xx - 127.5) * 0.0078125, yy))
+            imread = lambda idx: tf_imdecode(read_func(idx))
+        # keep_uint8=True for models doing normalization themselves, rounding only for uint8 output
+        process_image = lambda img: random_process_image(img, self.img_shape, random_status, random_crop)
+        if keep_uint8:
+            self.process_path = lambda idx: (tf.saturate_cast(tf.round(process_image(imread(idx))), tf.uint8), get_label(idx))
+        else:
+            self.process_path = lambda idx: (tf.cast(process_image(imread(idx)), tf.float32), get_label(idx))
+
+        # Sampled groups are flattened to single images, decoded and augmented in parallel, then batched back in the same order
+        initial_group = (initial_epoch * self.steps_per_epoch + initial_step) * batch_size
+        train_dataset = tf.data.Dataset.range(initial_group, np.iinfo(np.int64).max).batch(1024)
+        train_dataset = train_dataset.map(self.groups_sampler, num_parallel_calls=self.AUTOTUNE)
+        train_dataset = train_dataset.map(lambda xx: tf.reshape(xx, [-1])).unbatch()
+        train_dataset = train_dataset.map(self.process_path, num_parallel_calls=self.AUTOTUNE)
+        train_dataset = train_dataset.batch(self.batch_size * self.image_per_class)
+        if not keep_uint8:
+            train_dataset = train_dataset.map(lambda xx, yy: ((tf.cast(xx, "float32") - 127.5) * 0.0078125, yy))
         self.train_dataset = train_dataset.prefetch(buffer_size=self.AUTOTUNE)
         self.classes = classes
 
-    def image_data_shuffle_gen(self):
-        tf.print("Shuffle image data...")
-        shuffle_dataset = self.image_dataframe.map(self.split_func)
-        image_data = np.random.permutation(np.vstack(shuffle_dataset.values))
-        return (ii for ii in image_data)
-
-    def process_batch_path_1(self, image_name_batch):
-        image_names = tf.reshape(image_name_batch, [-1])
-        images, labels = tf.map_fn(self.process_path, image_names, dtype=(tf.float32, tf.int32))
-        return images, labels
-
-    def process_batch_path_2(self, image_name_batch):
-        image_names = tf.reshape(image_name_batch, [-1])
-        images, labels = tf.map_fn(self.process_path, image_names, fn_output_signature=(tf.float32, tf.int32))
-        return images, labels
+    def groups_sampler(self, group_counter):
+        """ Global group counter [batch] --> image positions [batch, image_per_class], epoch = group_counter // total_groups """
+        epoch = group_counter // self.total_groups
+        group_id = feistel_permute(group_counter % self.total_groups, self.total_groups, self.shuffle_seed, epoch)
+        group_class, group_rank = tf.gather(self.group_class, group_id), tf.gather(self.group_rank, group_id)
+        class_starts = tf.gather(self.class_starts, group_class)[:, None]
+        class_counts = tf.gather(self.class_counts, group_class)[:, None]
+        # Ranks in class permutation, [batch, image_per_class]. Each class has its own seed
+        in_class_ranks = group_rank[:, None] * self.image_per_class + tf.range(self.image_per_class, dtype=tf.int64)[None]
+        class_seed = self.shuffle_seed + 1 + group_class[:, None]
+        in_class_index = feistel_permute(in_class_ranks, class_counts, class_seed, epoch[:, None])
+        return tf.gather(self.sorted_index, class_starts + in_class_index)
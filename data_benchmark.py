@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+import data
+
+
+def get_rss_gb():
+    """ Current host RSS in GB, from /proc/self/status, or max RSS if not on linux """
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as ff:
+            for line in ff:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024 ** 2
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+
+
+def make_synthetic_dataset(save_dir, total_images=2000, classes=100, img_shape=(112, 112)):
+    """ Random noise JPEG images in class folders, and a manifest for them. Returns the manifest path """
+    # Image count / classes / shape in folder names, so a different `-S` value makes a new dataset
+    synthetic_name = "synthetic_%d_%d_%dx%d" % (total_images, classes, img_shape[0], img_shape[1])
+    manifest_dir = os.path.join(save_dir, synthetic_name + "_manifest")
+    if data.is_manifest(manifest_dir):
+        return manifest_dir
+    image_names, image_classes = [], []
+    for ii in tqdm(range(total_images), "Synthetic images"):
+        class_dir = os.path.join(save_dir, synthetic_name, str(ii % classes))
+        if not os.path.exists(class_dir):
+            os.makedirs(class_dir)
+        image_name = os.path.join(class_dir, "%d.jpg" % ii)
+        # Upsampled low resolution noise, JPEG size is closer to real face images than full resolution noise
+        img = tf.image.resize(np.random.uniform(0, 255, size=(14, 14, 3)), img_shape)
+        img = tf.saturate_cast(img, tf.uint8)
+        tf.io.write_file(image_name, tf.image.encode_jpeg(img, quality=95))
+        image_names.append(image_name)
+        image_classes.append(ii % classes)
+    shuffle = np.random.permutation(total_images)
+    data.save_manifest(manifest_dir, np.array(image_names)[shuffle], np.array(image_classes)[shuffle])
+    return manifest_dir
+
+
+def iterate_dataset(ds, steps, warmup=10):
+    """ Returns images / sec, step latencies in ms. First `warmup` steps not counted """
+    step_times, images = [], 0
+    iterator = iter(ds)
+    for _ in range(warmup):
+        next(iterator)
+    ss = time.time()
+    for _ in tqdm(range(steps), "Iterating"):
+        cur = time.time()
+        xx = next(iterator)
+        step_times.append(time.time() - cur)
+        images += int(tf.shape(xx[0] if isinstance(xx, tuple) else xx)[0])
+    return images / (time.time() - ss), np.array(step_times) * 1000
+
+
+def stage_datasets(data_path, batch_size):
+    """ Prefixes of the softmax pipeline, measuring each stage separately: read bytes, and read + decode """
+    positions, _, _, _, read_func = data.pre_process_image_source(data_path)
+    index_ds = data.permuted_index_dataset(len(positions), seed=0)
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+    read_ds = index_ds.map(read_func, num_parallel_calls=AUTOTUNE)
+    decode_ds = read_ds.map(data.tf_imdecode, num_parallel_calls=AUTOTUNE)
+    return {"read": read_ds.batch(batch_size).prefetch(AUTOTUNE), "decode": decode_ds.batch(batch_size).prefetch(AUTOTUNE)}
+
+
+def data_benchmark(
+    data_path,
+    steps=200,
+    batch_sizes=[128],
+    random_status=[0, 3],
+    triplet=False,
+    batch_augment=False,
+    keep_uint8=False,
+    cache=False,
+    data_service_workers=0,
+    warmup=10,
+):
+    results = []
+    print(">>>> data_path: %s, RSS before: %.2fGB" % (data_path, get_rss_gb()))
+    for batch_size in batch_sizes:
+        if not triplet and not data.is_tfrecord_dir(data_path):
+            for stage, ds in stage_datasets(data_path, batch_size).items():
+                images_per_sec, step_ms = iterate_dataset(ds, steps, warmup)
+                results.append({"dataset": "stage_" + stage, "batch_size": batch_size, "random_status": "-"})
+                results[-1].update({"images/sec": images_per_sec, "step_ms": step_ms, "rss_gb": get_rss_gb()})
+        for cur_random_status in random_status:
+            if triplet:
+                tt = data.Triplet_dataset(
+                    data_path, batch_size=batch_size // 4, random_status=cur_random_status, random_crop=(100, 100, 3), keep_uint8=keep_uint8
+                )
+                ds = tt.train_dataset
+            else:
+                ds = data.prepare_dataset(
+                    data_path,
+                    batch_size=batch_size,
+                    random_status=cur_random_status,
+                    random_crop=(100, 100, 3),
+                    cache=cache,
+                    batch_augment=batch_augment,
+                    keep_uint8=keep_uint8,
+                    data_service_workers=data_service_workers,
+                )
+            images_per_sec, step_ms = iterate_dataset(ds, steps, warmup)
+            results.append({"dataset": "triplet" if triplet else "softmax", "batch_size": batch_size, "random_status": cur_random_status})
+            results[-1].update({"images/sec": images_per_sec, "step_ms": step_ms, "rss_gb": get_rss_gb()})
+            print(">>>> %s" % {kk: vv for kk, vv in results[-1].items() if kk != "step_ms"})
+
+    print()
+    print("| dataset       | batch_size | random_status | images/sec | step mean ms | step p99 ms | RSS GB |")
+    print("| ------------- | ---------- | ------------- | ---------- | ------------ | ----------- | ------ |")
+    for rr in results:
+        step_ms_mean, step_ms_p99 = rr["step_ms"].mean(), np.percentile(rr["step_ms"], 99)
+        cur = (rr["dataset"], rr["batch_size"], rr["random_status"], rr["images/sec"], step_ms_mean, step_ms_p99, rr["rss_gb"])
+        print("| %-13s | %-10d | %-13s | %-10.1f | %-12.2f | %-11.2f | %-6.2f |" % cur)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-D", "--data_path", type=str, default=None, help="Dataset path, folder / manifest / MXnet record / tfrecords")
+    parser.add_argument("-S", "--synthetic", type=int, default=0, help="Benchmark on [NUM] synthetic JPEG images instead of data_path")
+    parser.add_argument("-s", "--steps", type=int, default=200, help="Steps to iterate for each combination")
+    parser.add_argument("-w", "--warmup", type=int, default=10, help="Warmup steps not counted")
+    parser.add_argument("-b", "--batch_sizes", nargs="+", type=int, default=[128], help="Batch sizes to test")
+    parser.add_argument("-r", "--random_status", nargs="+", type=int, default=[0, 3], help="random_status values to test")
+    parser.add_argument("-t", "--triplet", action="store_true", help="Benchmark Triplet_dataset instead of prepare_dataset")
+    parser.add_argument("--batch_augment", action="store_true", help="prepare_dataset batch_augment")
+    parser.add_argument("--keep_uint8", action="store_true", help="Keep images uint8, for models built with uint8_input=True")
+    parser.add_argument("--cache", action="store_true", help="prepare_dataset decoded image cache")
+    parser.add_argument("--data_service_workers", type=int, default=0, help="prepare_dataset local tf.data service workers")
+    args = parser.parse_known_args(sys.argv[1:])[0]
+
+    if args.synthetic > 0:
+        args.data_path = make_synthetic_dataset(os.path.join(tempfile.gettempdir(), "data_benchmark"), args.synthetic)
+    elif args.data_path is None:
+        print(">>>> Either data_path or synthetic should be provided")
+        sys.exit(1)
+
+    data_benchmark(
+        args.data_path,
+        steps=args.steps,
+        batch_sizes=args.batch_sizes,
+        random_status=args.random_status,
+        triplet=args.triplet,
+        batch_augment=args.batch_augment,
+        keep_uint8=args.keep_uint8,
+        cache=args.cache,
+        data_service_workers=args.data_service_workers,
+        warmup=args.warmup,
+    )
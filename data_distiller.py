@@ -4,7 +4,7 @@ import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
 from sklearn.preprocessing import normalize
-from data import pre_process_folder, tf_imread
+from data import pre_process_folder, pre_process_image_source, save_manifest, tf_imdecode, tf_imread, keras_model_infer
 
 gpus = tf.config.experimental.list_physical_devices("GPU")
 for gpu in gpus:
@@ -44,50 +44,57 @@ def mxnet_model_infer(model, imgs):
     return emb
 
 
-def data_distiller(data_path, model, dest_file=None, batch_size=256, limit=-1):
+def data_distiller(data_path, model, dest_file=None, batch_size=256, limit=-1, emb_dtype="float32"):
     """ Init dataset """
-    image_names, image_classes, _, classes, dataset_pickle_file_src = pre_process_folder(data_path)
-    print(">>>> Image length: %d, Image class length: %d, classes: %d" % (len(image_names), len(image_classes), classes))
+    image_names, _, _, _, dataset_pickle_file_src = pre_process_folder(data_path)
+    # Pipeline carries int positions, image bytes are read by position, names are only created for saving
+    positions, image_classes, _, classes, read_func = pre_process_image_source(data_path)
+    print(">>>> Image length: %d, Image class length: %d, classes: %d" % (len(positions), len(image_classes), classes))
     if limit > 0:
-        image_names, image_classes = image_names[:limit], image_classes[:limit]
+        positions = positions[:limit]
 
     AUTOTUNE = tf.data.experimental.AUTOTUNE
-    ds = tf.data.Dataset.from_tensor_slices((image_names, image_classes))
-    ds = ds.batch(batch_size)
-    total = int(np.ceil(len(image_names) // batch_size)) + 1
+    ds = tf.data.Dataset.from_tensor_slices((positions, np.asarray(image_classes)[positions]))
+    ds = ds.map(lambda pos, label: (tf_imdecode(read_func(pos)), pos, label), num_parallel_calls=AUTOTUNE)
+    ds = ds.batch(batch_size).prefetch(buffer_size=AUTOTUNE)
+    total = int(np.ceil(len(positions) / batch_size))
 
     """ Init model, it could be TF model / MXNet model file / keras model file """
     if isinstance(model, str):
         if model.endswith(".h5"):
             # Keras model file
             basic_model = tf.keras.models.load_model(model, compile=False)
-            infer = lambda imgs: basic_model((imgs - 127.5) * 0.0078125).numpy()
+            infer = keras_model_infer(basic_model)
         else:
             # MXNet model file, like models/r50-arcface-emore/model,1
             basic_model = get_mxnet_model(model)
             infer = lambda imgs: mxnet_model_infer(basic_model, imgs.numpy().astype("uint8"))
     else:
         # TF model
-        infer = lambda imgs: model((imgs - 127.5) * 0.0078125).numpy()
+        infer = keras_model_infer(model)
 
     """ Extract embeddings """
-    new_image_names, new_image_classes, embeddings = [], [], []
-    for imm, label in tqdm(ds, "Embedding", total=total):
-        imgs = tf.stack([tf_imread(ii) for ii in imm])
+    new_positions, new_image_classes, embeddings = [], [], []
+    for imgs, pos, label in tqdm(ds, "Embedding", total=total):
         emb = normalize(infer(imgs), axis=1)
 
-        new_image_names.extend(imm.numpy())
+        new_positions.extend(pos.numpy())
         new_image_classes.extend(label.numpy())
         embeddings.extend(emb)
-    # imms, labels, embeddings = np.array(imms), np.array(labels), np.array(embeddings)
+    new_image_names = image_names[np.array(new_positions)]
+    # float16 halves the saved size, prepare_dataset gathers them from a memmap array as float32
+    embeddings = np.array(embeddings, dtype=emb_dtype)
 
-    """ Save to npz """
+    """ Save to manifest, or npz if dest_file endswith `.npz` """
     print(">>>> Saving locally...")
     if dest_file is None:
         src_name = os.path.splitext(os.path.basename(dataset_pickle_file_src))[0]
-        dest_file = src_name + "_label_embs_normed_{}.npz".format(embeddings[0].shape[0])
-    dest_file = dest_file if dest_file.endswith(".npz") else dest_file + ".npz"
-    np.savez_compressed(dest_file, image_names=new_image_names, image_classes=new_image_classes, embeddings=embeddings)
+        src_name = src_name[: -len("_manifest")] if src_name.endswith("_manifest") else src_name
+        dest_file = src_name + "_label_embs_normed_{}_manifest".format(embeddings[0].shape[0])
+    if dest_file.endswith(".npz"):
+        np.savez_compressed(dest_file, image_names=new_image_names, image_classes=new_image_classes, embeddings=embeddings)
+    else:
+        save_manifest(dest_file, new_image_names, new_image_classes, embeddings)
     # with open(dest_file, "wb") as ff:
     #     pickle.dump({"image_names": new_image_names, "image_classes": new_image_classes, "embeddings": embeddings}, ff)
     print(">>>> Output:", dest_file)
@@ -104,12 +111,13 @@ if __name__ == "__main__":
         "-M", "--model_file", type=str, required=True, help="Saved basic_model file path, NOT model, could be keras / mxnet one"
     )
     parser.add_argument("-D", "--data_path", type=str, required=True, help="Original dataset path")
-    parser.add_argument("-d", "--dest_file", type=str, default=None, help="Dest file path to save the processed dataset npz")
+    parser.add_argument("-d", "--dest_file", type=str, default=None, help="Dest path to save the processed dataset manifest, or npz if endswith .npz")
     parser.add_argument("-b", "--batch_size", type=int, default=256, help="Batch size")
     parser.add_argument("-L", "--limit", type=int, default=-1, help="Test parameter, limit converting only the first [NUM]")
+    parser.add_argument("-t", "--emb_dtype", type=str, default="float32", help="Saved embeddings dtype, float32 or float16")
     args = parser.parse_known_args(sys.argv[1:])[0]
 
-    data_distiller(args.data_path, args.model_file, args.dest_file, args.batch_size, args.limit)
+    data_distiller(args.data_path, args.model_file, args.dest_file, args.batch_size, args.limit, args.emb_dtype)
 
 elif __name__ == "__test__":
     batch_size = 256
@@ -4,7 +4,7 @@ import numpy as np
 import tensorflow as tf
 from tqdm import tqdm
 from sklearn.preprocessing import normalize
-from data import pre_process_folder, tf_imread
+from data import pre_process_folder, save_manifest, tf_imread, keras_model_infer
 
 gpus = tf.config.experimental.list_physical_devices("GPU")
 for gpu in gpus:
@@ -15,8 +15,9 @@ def data_drop_top_k(model, data_path, dest_file=None, deg_thresh=75, limit=0):
     cos_thresh = np.cos(np.pi * deg_thresh / 180)  # 0.25881904510252074
 
     image_names, image_classes, _, _, dataset_pickle_file_src = pre_process_folder(data_path)  # Reload from pickle file
-    sorted_idx = np.argsort(image_classes)
-    image_names, image_classes = np.array(image_names)[sorted_idx], np.array(image_classes)[sorted_idx]
+    # Positions sorted by class, names are only created per class when used
+    sorted_idx = np.argsort(image_classes, kind="stable")
+    sorted_classes = np.asarray(image_classes)[sorted_idx]
 
     if isinstance(model, str):
         from train import NormDense
@@ -25,6 +26,7 @@ def data_drop_top_k(model, data_path, dest_file=None, deg_thresh=75, limit=0):
     else:
         mm = model
     basic_model = tf.keras.models.Model(mm.inputs[0], mm.layers[-2].output)
+    infer = keras_model_infer(basic_model)
 
     output_layer = mm.layers[-1]
     centers = normalize(output_layer.weights[0].numpy(), axis=0)
@@ -41,10 +43,10 @@ def data_drop_top_k(model, data_path, dest_file=None, deg_thresh=75, limit=0):
     new_image_classes, new_image_names = [], []
     total_idxes = class_num if limit == 0 else limit
     for ii in tqdm(range(total_idxes)):
-        imms = image_names[image_classes == ii]
+        class_start, class_end = np.searchsorted(sorted_classes, [ii, ii + 1])
+        imms = image_names[sorted_idx[class_start:class_end]]
         imgs = tf.stack([tf_imread(imm) for imm in imms])
-        imgs = (imgs - 127.5) * 0.0078125
-        embs = normalize(basic_model(imgs).numpy(), axis=1)
+        embs = normalize(infer(imgs), axis=1)
 
         """ Find the best center """
         sub_centers = centers[:, ii * top_k : (ii + 1) * top_k]  # (256, 3)
@@ -71,11 +73,15 @@ def data_drop_top_k(model, data_path, dest_file=None, deg_thresh=75, limit=0):
     shuffle_idxes = np.random.permutation(len(new_image_names))
     new_image_classes, new_image_names = new_image_classes[shuffle_idxes].tolist(), new_image_names[shuffle_idxes].tolist()
 
-    """ Save to npz """
+    """ Save to manifest, or npz if dest_file endswith `.npz` """
     if dest_file is None:
         src_name = os.path.splitext(os.path.basename(dataset_pickle_file_src))[0]
-        dest_file = src_name + "_topK{}_deg{}.npz".format(top_k, deg_thresh)
-    np.savez_compressed(dest_file, image_names=new_image_names, image_classes=new_image_classes)
+        src_name = src_name[: -len("_manifest")] if src_name.endswith("_manifest") else src_name
+        dest_file = src_name + "_topK{}_deg{}_manifest".format(top_k, deg_thresh)
+    if dest_file.endswith(".npz"):
+        np.savez_compressed(dest_file, image_names=new_image_names, image_classes=new_image_classes)
+    else:
+        save_manifest(dest_file, new_image_names, new_image_classes)
     # with open(dest_file, "wb") as ff:
     #     pickle.dump({"image_names": new_image_names, "image_classes": new_image_classes}, ff)
 
@@ -91,7 +97,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-M", "--model_file", type=str, required=True, help="Saved model file path, NOT basic_model")
     parser.add_argument("-D", "--data_path", type=str, required=True, help="Original dataset path")
-    parser.add_argument("-d", "--dest_file", type=str, default=None, help="Dest file path to save the processed dataset npz")
+    parser.add_argument("-d", "--dest_file", type=str, default=None, help="Dest path to save the processed dataset manifest, or npz if endswith .npz")
     parser.add_argument("-t", "--deg_thresh", type=int, default=75, help="Thresh value in degree, [0, 180]")
     parser.add_argument("-L", "--limit", type=int, default=0, help="Test parameter, limit converting only the first [NUM] ones")
     args = parser.parse_known_args(sys.argv[1:])[0]
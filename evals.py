@@ -1,5 +1,6 @@
 import pickle
 import os
+import threading
 import io
 from tqdm import tqdm
 from skimage.io import imread
@@ -16,21 +17,39 @@ from sklearn.decomposition import PCA
 
 
 class eval_callback(tf.keras.callbacks.Callback):
-    def __init__(self, basic_model, test_bin_file, batch_size=128, save_model=None, eval_freq=1, flip=True, PCA_acc=False):
+    def __init__(self, basic_model, test_bin_file, batch_size=128, save_model=None, eval_freq=1, flip=True, PCA_acc=False, async_eval=False):
         super(eval_callback, self).__init__()
-        bins, issame_list = np.load(test_bin_file, encoding="bytes", allow_pickle=True)
-        ds = tf.data.Dataset.from_tensor_slices(bins)
-        _imread = lambda xx: (tf.cast(tf.image.decode_jpeg(xx, channels=3), "float32") - 127.5) * 0.0078125
-        ds = ds.map(_imread)
-        self.ds = ds.batch(batch_size)
-        if flip:
-            self.ds_flip = self.ds.map(lambda xx: tf.image.flip_left_right(xx))
+        test_bin_file = test_bin_file[:-1] if test_bin_file.endswith(os.sep) else test_bin_file
+        if tf.distribute.has_strategy():
+            # batch_size a multiple of num_replicas, so each replica gets an equal contiguous shard of every batch
+            num_replicas = tf.distribute.get_strategy().num_replicas_in_sync
+            batch_size = int(np.ceil(batch_size / num_replicas)) * num_replicas
+        if os.path.isdir(test_bin_file):
+            # Decoded folder from `prepare_data.py -P`, uint8 images in memmap, no decoding on every evaluation
+            images = np.load(os.path.join(test_bin_file, "images.npy"), mmap_mode="r")
+            issame_list = np.load(os.path.join(test_bin_file, "issame.npy"))
+            gen = lambda: (images[ii : ii + batch_size] for ii in range(0, len(images), batch_size))
+            ds = tf.data.Dataset.from_generator(gen, output_types=tf.uint8, output_shapes=(None, *images.shape[1:]))
+            total = len(images)
+            test_names = os.path.basename(test_bin_file)
+            self.test_names = test_names[: -len("_decoded")] if test_names.endswith("_decoded") else test_names
+        else:
+            bins, issame_list = np.load(test_bin_file, encoding="bytes", allow_pickle=True)
+            ds = tf.data.Dataset.from_tensor_slices(bins)
+            ds = ds.map(lambda xx: tf.image.decode_jpeg(xx, channels=3)).batch(batch_size)
+            total = len(bins)
+            self.test_names = os.path.splitext(os.path.basename(test_bin_file))[0]
+        if basic_model.inputs[0].dtype != tf.uint8:
+            # Model built with uint8_input=True does normalization itself
+            ds = ds.map(lambda xx: (tf.cast(xx, "float32") - 127.5) * 0.0078125)
+        self.ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
         self.test_issame = np.array(issame_list)
-        self.test_names = os.path.splitext(os.path.basename(test_bin_file))[0]
-        self.steps = int(np.ceil(len(bins) / batch_size))
-        self.basic_model = basic_model
+        self.steps, self.total = int(np.ceil(total / batch_size)), total
+        self.basic_model, self.flip = basic_model, flip
+        self.predict_model = self.__build_predict_model__(basic_model)
+        self.predict_func = tf.function(lambda xx: self.predict_model(xx, training=False), experimental_relax_shapes=True)
         self.max_accuracy, self.cur_acc = 0.0, 0.0
-        self.save_model, self.eval_freq, self.flip, self.PCA_acc = save_model, eval_freq, flip, PCA_acc
+        self.save_model, self.eval_freq, self.PCA_acc = save_model, eval_freq, PCA_acc
         if eval_freq > 1:
             # If eval_freq > 1, do evaluation on batch, and also on epoch.
             self.on_batch_end = lambda batch=0, logs=None: self.__eval_func__(batch, logs, eval_freq=eval_freq)
@@ -39,33 +58,45 @@ class eval_callback(tf.keras.callbacks.Callback):
         self.is_distribute = False
         if tf.distribute.has_strategy():
             self.is_distribute = True
-            strategy = tf.distribute.get_strategy()
+            self.strategy = strategy = tf.distribute.get_strategy()
             self.num_replicas = strategy.num_replicas_in_sync
-
-    def __do_predict__(self):
+            # Pad the last batch to full batch_size, the padded ones are dropped after prediction
+            pad_func = lambda xx: tf.pad(xx, [[0, batch_size - tf.shape(xx)[0]]] + [[0, 0]] * (len(xx.shape) - 1))
+            self.distribute_ds = strategy.experimental_distribute_dataset(self.ds.map(pad_func))
+            self.distribute_predict_func = tf.function(lambda xx: strategy.run(self.predict_func, args=(xx,)))
+
+        # Async eval runs on a CPU replica of basic_model in a background thread, training continues meanwhile
+        self.async_eval = async_eval and not self.is_distribute
+        if async_eval and self.is_distribute:
+            print(">>>> async_eval not supported under distribute strategy, fall back to synchronous evaluation")
+        self.eval_model, self.eval_thread, self.eval_lock, self.async_results = None, None, threading.Lock(), []
+
+    def __build_predict_model__(self, basic_model):
+        if not self.flip:
+            return basic_model
+        # Fused flip, one forward on [x; flip(x)], and the two halves summed on device
+        inputs = tf.keras.layers.Input(basic_model.input_shape[1:], dtype=basic_model.inputs[0].dtype)
+        nn = tf.keras.layers.Lambda(lambda xx: tf.concat([xx, tf.image.flip_left_right(xx)], axis=0))(inputs)
+        nn = basic_model(nn)
+        nn = tf.keras.layers.Lambda(lambda xx: tf.add(*tf.split(xx, 2, axis=0)))(nn)
+        return tf.keras.models.Model(inputs, nn)
+
+    def __do_predict__(self, predict_func=None):
+        predict_func = self.predict_func if predict_func is None else predict_func
         embs = []
-        for img_batch in tqdm(self.ds, "Evaluating " + self.test_names, total=self.steps):
-            emb = self.basic_model(img_batch)
-            if self.flip:
-                emb_f = self.basic_model(tf.image.flip_left_right(img_batch))
-                emb = emb + emb_f
+        for img_batch in tqdm(self.ds, "Evaluating " + self.test_names, total=self.steps, disable=self.async_eval):
+            emb = predict_func(img_batch)
             embs.extend(emb.numpy())
         return np.array(embs)
 
     def __do_predict_distribute__(self):
         embs = []
-        pp = self.basic_model.make_predict_function()
-        aa = iter(self.ds)
-        if self.flip:
-            bb = iter(self.ds_flip)
-        for _ in tqdm(range(self.steps), "Evaluating " + self.test_names, total=self.steps):
-            emb = pp(aa)
-            if self.flip:
-                emb_f = pp(bb)
-                emb = emb + emb_f
-            # Dont know how to handle this, for multi GPU, emb is calculated multi times...
-            embs.extend(emb[: emb.shape[0] // self.num_replicas].numpy())
-        return np.array(embs)
+        for img_batch in tqdm(self.distribute_ds, "Evaluating " + self.test_names, total=self.steps):
+            emb = self.distribute_predict_func(img_batch)
+            # Each replica gets a contiguous shard of the global batch, concat local results in replica order
+            embs.extend(np.concatenate([ii.numpy() for ii in self.strategy.experimental_local_results(emb)], axis=0))
+        # Drop padded ones
+        return np.array(embs[: self.total])
 
     def __eval_func__(self, cur_step=0, logs=None, eval_freq=1):
         # print("self.model.params:", self.model.params if self.model else "None")
@@ -83,17 +114,60 @@ class eval_callback(tf.keras.callbacks.Callback):
             cur_step = "%d_batch_%d" % (cur_epoch + 1, cur_step)
         else:
             cur_step = str(cur_step + 1)
-        dists = []
+        if self.async_eval:
+            self.__start_async_eval__(cur_step, is_epoch_end=eval_freq == 1)
+            return
         tf.print("")
         if self.is_distribute:
             embs = self.__do_predict_distribute__()
         else:
             embs = self.__do_predict__()
-
+        self.__score__(embs, cur_step, self.basic_model)
+
+    def __start_async_eval__(self, cur_step, is_epoch_end=True):
+        # One evaluation at a time, so the replica weights stay the evaluated ones until scored and saved
+        self.wait_async_eval()
+        if self.eval_model is None:
+            with tf.device("/cpu:0"):
+                self.eval_model = tf.keras.models.clone_model(self.basic_model)
+                eval_predict_model = self.__build_predict_model__(self.eval_model)
+            self.eval_predict_func = tf.function(lambda xx: eval_predict_model(xx, training=False), experimental_relax_shapes=True)
+        self.eval_model.set_weights(self.basic_model.get_weights())
+        self.eval_thread = threading.Thread(target=self.__async_eval_worker__, args=(cur_step, is_epoch_end), daemon=True)
+        self.eval_thread.start()
+
+    def __async_eval_worker__(self, cur_step, is_epoch_end):
+        acc = float("nan")  # NaN in history for a failed evaluation, not the previous value
+        try:
+            with tf.device("/cpu:0"):
+                embs = self.__do_predict__(self.eval_predict_func)
+            if self.__score__(embs, cur_step, self.eval_model):
+                acc = self.cur_acc
+        except Exception as ee:
+            print(">>>> %s async evaluation failed: %s" % (self.test_names, ee))
+        if is_epoch_end:
+            # Picked up by My_history in order, one value per epoch same as synchronous evaluation
+            with self.eval_lock:
+                self.async_results.append(acc)
+
+    def wait_async_eval(self):
+        if self.eval_thread is not None:
+            self.eval_thread.join()
+            self.eval_thread = None
+
+    def pop_async_results(self):
+        with self.eval_lock:
+            results, self.async_results = self.async_results, []
+        return results
+
+    def on_train_end(self, logs=None):
+        self.wait_async_eval()
+
+    def __score__(self, embs, cur_step, model_to_save):
         # tf.print("embs.shape: ", embs.shape)
         if np.isnan(embs).sum() != 0:
             tf.print("NAN in embs, not a good one")
-            return
+            return False
         embs = normalize(embs)
         embs_a = embs[::2]
         embs_b = embs[1::2]
@@ -105,11 +179,7 @@ class eval_callback(tf.keras.callbacks.Callback):
         self.ff = ff
         self.embs = embs
 
-        t_steps = int(0.1 * ff.shape[0])
-        acc_count = np.array([(tt > vv).sum() + (ff <= vv).sum() for vv in ff[-t_steps:]])
-        acc_max_indx = np.argmax(acc_count)
-        acc_max = acc_count[acc_max_indx] / dists.shape[0]
-        acc_thresh = ff[acc_max_indx - t_steps]
+        acc_max, acc_thresh = best_threshold_accuracy(dists, self.test_issame[: dists.shape[0]])
         self.cur_acc = acc_max
 
         if self.PCA_acc:
@@ -135,7 +205,25 @@ class eval_callback(tf.keras.callbacks.Callback):
                     os.remove(ii)
                 save_path = save_path_base + "%s_%f.h5" % (cur_step, self.max_accuracy)
                 tf.print("Saving model to: %s" % (save_path))
-                self.basic_model.save(save_path, include_optimizer=False)
+                model_to_save.save(save_path, include_optimizer=False)
+        return True
+
+
+def best_threshold_accuracy(dists, issame):
+    """Exact max accuracy over all thresholds, predicting same if dist > thresh.
+    One sort, then correct counts for every threshold by cumulative sums, so O(n log n).
+    """
+    issame = np.asarray(issame, dtype="bool")
+    order = np.argsort(dists, kind="stable")
+    sorted_dists, sorted_issame = dists[order], issame[order]
+    cum_tt, cum_ff = np.cumsum(sorted_issame), np.cumsum(np.logical_not(sorted_issame))
+    # Thresh at sorted_dists[ii] predicts all <= it as different, only the last one in a tie group is a valid split
+    acc_count = np.where(np.append(sorted_dists[1:] != sorted_dists[:-1], True), cum_tt[-1] - cum_tt + cum_ff, -1)
+    acc_max_indx = np.argmax(acc_count)
+    if cum_tt[-1] > acc_count[acc_max_indx]:
+        # Thresh below all, predicting all as same
+        return cum_tt[-1] / dists.shape[0], np.nextafter(sorted_dists[0], -np.inf)
+    return acc_count[acc_max_indx] / dists.shape[0], sorted_dists[acc_max_indx]
 
 
 def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_folds=10, pca=0):
@@ -175,15 +263,10 @@ def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_fold
             dist = np.sum(np.square(diff), 1)
 
         # Find the best threshold for the fold
-        acc_train = np.zeros((nrof_thresholds))
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, _, acc_train[threshold_idx] = calculate_accuracy(threshold, dist[train_set], actual_issame[train_set])
+        _, _, acc_train = calculate_accuracy_all(thresholds, dist[train_set], actual_issame[train_set])
         best_threshold_index = np.argmax(acc_train)
-        for threshold_idx, threshold in enumerate(thresholds):
-            tprs[fold_idx, threshold_idx], fprs[fold_idx, threshold_idx], _ = calculate_accuracy(
-                threshold, dist[test_set], actual_issame[test_set]
-            )
-        _, _, accuracy[fold_idx] = calculate_accuracy(thresholds[best_threshold_index], dist[test_set], actual_issame[test_set])
+        tprs[fold_idx], fprs[fold_idx], acc_test = calculate_accuracy_all(thresholds, dist[test_set], actual_issame[test_set])
+        accuracy[fold_idx] = acc_test[best_threshold_index]
 
     tpr = np.mean(tprs, 0)
     fpr = np.mean(fprs, 0)
@@ -207,7 +290,6 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
     assert embeddings1.shape[0] == embeddings2.shape[0]
     assert embeddings1.shape[1] == embeddings2.shape[1]
     nrof_pairs = min(len(actual_issame), embeddings1.shape[0])
-    nrof_thresholds = len(thresholds)
     k_fold = KFold(n_splits=nrof_folds, shuffle=False)
 
     val = np.zeros(nrof_folds)
@@ -220,9 +302,7 @@ def calculate_val(thresholds, embeddings1, embeddings2, actual_issame, far_targe
     for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):
 
         # Find the threshold that gives FAR = far_target
-        far_train = np.zeros(nrof_thresholds)
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, far_train[threshold_idx] = calculate_val_far(threshold, dist[train_set], actual_issame[train_set])
+        _, far_train = calculate_val_far_all(thresholds, dist[train_set], actual_issame[train_set])
         if np.max(far_train) >= far_target:
             f = interpolate.interp1d(far_train, thresholds, kind="slinear")
             threshold = f(far_target)
@@ -248,6 +328,36 @@ def calculate_val_far(threshold, dist, actual_issame):
     return val, far
 
 
+def threshold_counts(thresholds, dist, actual_issame):
+    """tp, fp, tn, fn for all thresholds at once, predicting same if dist < threshold.
+    Sort dist once, then count of dist < threshold is a searchsorted, and tp among them a cumsum lookup.
+    """
+    actual_issame = np.asarray(actual_issame, dtype="bool")
+    order = np.argsort(dist, kind="stable")
+    cum_same = np.concatenate([[0], np.cumsum(actual_issame[order])])
+    predict_same = np.searchsorted(dist[order], thresholds, side="left")
+    tp = cum_same[predict_same]
+    fp = predict_same - tp
+    fn = cum_same[-1] - tp
+    tn = (dist.shape[0] - cum_same[-1]) - fp
+    return tp, fp, tn, fn
+
+
+def calculate_accuracy_all(thresholds, dist, actual_issame):
+    """Vectorized calculate_accuracy, returns tpr, fpr, acc arrays for all thresholds"""
+    tp, fp, tn, fn = threshold_counts(thresholds, dist, actual_issame)
+    tpr = np.where(tp + fn == 0, 0, tp / np.maximum(tp + fn, 1))
+    fpr = np.where(fp + tn == 0, 0, fp / np.maximum(fp + tn, 1))
+    acc = (tp + tn) / dist.size
+    return tpr, fpr, acc
+
+
+def calculate_val_far_all(thresholds, dist, actual_issame):
+    """Vectorized calculate_val_far, returns val, far arrays for all thresholds"""
+    tp, fp, tn, fn = threshold_counts(thresholds, dist, actual_issame)
+    return tp / (tp + fn), fp / (fp + tn)
+
+
 def evaluate(embeddings, actual_issame, nrof_folds=10, pca=0):
     # Calculate evaluation metrics
     thresholds = np.arange(0, 4, 0.01)
@@ -4,13 +4,29 @@ import os
 import tensorflow.keras.backend as K
 
 
+# Sparse int labels [batch] or [batch, 1] --> one-hot on device, one-hot labels are returned as is
+def convert_to_one_hot(y_true, y_pred):
+    if y_true.shape.rank == 1 or (y_true.shape[-1] == 1 and y_pred.shape[-1] != 1):
+        return tf.one_hot(tf.cast(tf.reshape(y_true, [-1]), tf.int32), depth=tf.shape(y_pred)[-1], dtype=y_pred.dtype)
+    return y_true
+
+
+# One-hot labels [batch, classes] or sparse int labels [batch] / [batch, 1] --> int class ids [batch]
+def convert_to_class_ids(y_true):
+    if y_true.shape.rank == 1 or y_true.shape[-1] == 1:
+        return tf.cast(tf.reshape(y_true, [-1]), tf.int64)
+    return tf.argmax(y_true, axis=1)
+
+
 def scale_softmax(y_true, y_pred, scale=64.0, from_logits=False, label_smoothing=0):
+    y_true = convert_to_one_hot(y_true, y_pred)
     return tf.keras.losses.categorical_crossentropy(
         y_true, y_pred * scale, from_logits=from_logits, label_smoothing=label_smoothing
     )
 
 
 def margin_softmax(y_true, y_pred, power=2, scale=0.4, from_logits=False, label_smoothing=0):
+    y_true = convert_to_one_hot(y_true, y_pred)
     margin_soft = tf.where(tf.cast(y_true, dtype=tf.bool), (y_pred ** power + y_pred * scale) / 2, y_pred)
     return tf.keras.losses.categorical_crossentropy(
         y_true, margin_soft, from_logits=from_logits, label_smoothing=label_smoothing
@@ -24,6 +40,7 @@ class MarginSoftmax(tf.keras.losses.Loss):
         self.power, self.scale, self.from_logits, self.label_smoothing = power, scale, from_logits, label_smoothing
 
     def call(self, y_true, y_pred):
+        y_true = convert_to_one_hot(y_true, y_pred)
         margin_soft = tf.where(tf.cast(y_true, dtype=tf.bool), (y_pred ** self.power + y_pred * self.scale) / 2, y_pred)
         return tf.keras.losses.categorical_crossentropy(
             y_true, margin_soft, from_logits=self.from_logits, label_smoothing=self.label_smoothing
@@ -52,6 +69,7 @@ def arcface_loss(y_true, y_pred, margin1=1.0, margin2=0.5, margin3=0.0, scale=64
     threshold = np.cos((np.pi - margin2) / margin1)
     theta_min = (-1 - margin3) * 2
     norm_logits = y_pred
+    y_true = convert_to_one_hot(y_true, norm_logits)
     y_pred_vals = norm_logits[tf.cast(y_true, dtype=tf.bool)]
     # y_pred_vals = tf.clip_by_value(y_pred_vals, clip_value_min=-1.0, clip_value_max=1.0)
     if margin1 == 1.0 and margin3 == 0.0:
@@ -88,6 +106,7 @@ class ArcfaceLoss(tf.keras.losses.Loss):
         # )
 
     def call(self, y_true, norm_logits):
+        y_true = convert_to_one_hot(y_true, norm_logits)
         # norm_logits = y_pred
         pick_cond = tf.cast(y_true, dtype=tf.bool)
         y_pred_vals = norm_logits[pick_cond]
@@ -134,6 +153,7 @@ class ArcfaceLossT4(tf.keras.losses.Loss):
         self.low_pred_punish = tf.sin(np.pi - margin) * margin
 
     def call(self, y_true, norm_logits):
+        y_true = convert_to_one_hot(y_true, norm_logits)
         pick_cond = tf.cast(y_true, dtype=tf.bool)
         y_pred_vals = norm_logits[pick_cond]
         theta = y_pred_vals * self.margin_cos - tf.sqrt(1 - tf.pow(y_pred_vals, 2)) * self.margin_sin
@@ -179,6 +199,7 @@ class AdaCosLossSimple(tf.keras.losses.Loss):
 
     @tf.function
     def call(self, y_true, norm_logits):
+        y_true = convert_to_one_hot(y_true, norm_logits)
         pick_cond = tf.cast(y_true, dtype=tf.bool)
         y_pred_vals = norm_logits[pick_cond]
         theta = tf.acos(y_pred_vals)
@@ -247,6 +268,7 @@ class AdaCosLossT4(tf.keras.losses.Loss):
 
     @tf.function
     def call(self, y_true, norm_logits):
+        y_true = convert_to_one_hot(y_true, norm_logits)
         pick_cond = tf.cast(y_true, dtype=tf.bool)
         y_pred_vals = norm_logits[pick_cond]
         theta_med = tf.sort(y_pred_vals)[self.med_pos]
@@ -319,7 +341,7 @@ class CenterLoss(tf.keras.losses.Loss):
 
     def call(self, y_true, embedding):
         # embedding = y_pred[:, : self.emb_shape]
-        labels = tf.argmax(y_true, axis=1)
+        labels = convert_to_class_ids(y_true)
         centers_batch = tf.gather(self.centers, labels)
         # loss = tf.reduce_mean(tf.square(embedding - centers_batch))
         loss = tf.reduce_sum(tf.square(embedding - centers_batch), axis=-1)
@@ -362,7 +384,7 @@ class CenterLoss(tf.keras.losses.Loss):
 
 
 def batch_hard_triplet_loss(labels, embeddings, alpha=0.35):
-    labels = tf.argmax(labels, axis=1)
+    labels = convert_to_class_ids(labels)
     # labels = tf.squeeze(labels)
     # labels.set_shape([None])
     pos_mask = tf.equal(tf.expand_dims(labels, 0), tf.expand_dims(labels, 1))
@@ -380,7 +402,7 @@ def batch_hard_triplet_loss(labels, embeddings, alpha=0.35):
 
 
 def batch_all_triplet_loss(labels, embeddings, alpha=0.35):
-    labels = tf.argmax(labels, axis=1)
+    labels = convert_to_class_ids(labels)
     # labels = tf.squeeze(labels)
     # labels.set_shape([None])
     pos_mask = tf.equal(tf.expand_dims(labels, 0), tf.expand_dims(labels, 1))
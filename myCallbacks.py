@@ -44,7 +44,12 @@ class My_history(keras.callbacks.Callback):
             k = "accuracy" if "accuracy" in k else k
             self.history.setdefault(k, []).append(float(v))
         for ee in self.evals:
-            self.history.setdefault(ee.test_names, []).append(float(ee.cur_acc))
+            if ee.async_eval:
+                # Async results come later than their epoch, published here once finished. List index is still the epoch,
+                # but it's usually one shorter than `loss` till on_train_end. Failed ones are NaN
+                self.history.setdefault(ee.test_names, []).extend([float(ii) for ii in ee.pop_async_results()])
+            else:
+                self.history.setdefault(ee.test_names, []).append(float(ee.cur_acc))
         for kk, vv in self.custom_obj.items():
             tt = losses_utils.compute_weighted_loss(vv())
             self.history.setdefault(kk, []).append(tt)
@@ -57,6 +62,20 @@ class My_history(keras.callbacks.Callback):
             with open(self.initial_file, "w") as ff:
                 json.dump(self.history, ff)
 
+    def on_train_end(self, logs=None):
+        async_results = {}
+        for ee in self.evals:
+            if ee.async_eval:
+                ee.wait_async_eval()
+                async_results[ee.test_names] = [float(ii) for ii in ee.pop_async_results()]
+        if sum([len(ii) for ii in async_results.values()]) == 0:
+            return
+        for kk, vv in async_results.items():
+            self.history.setdefault(kk, []).extend(vv)
+        if self.initial_file:
+            with open(self.initial_file, "w") as ff:
+                json.dump(self.history, ff)
+
     def print_hist(self):
         for kk, vv in self.history.items():
             print("  %s = %s" % (kk, vv))
@@ -78,6 +97,48 @@ class OptimizerWeightDecay(keras.callbacks.Callback):
         print("Weight decay for iter {} is {}".format(step + 1, wd))
 
 
+class DataPositionCheckpoint(ModelCheckpoint):
+    """ModelCheckpoint also saving input pipeline position `{"epoch", "step", "shuffle_seed"}` to `*_data_position.json`.
+    Position is written right after each model save, so a restarted training can resume from the exact sample.
+    """
+
+    def __init__(self, filepath, shuffle_seed=None, **kwargs):
+        super(DataPositionCheckpoint, self).__init__(filepath, **kwargs)
+        self.position_file = os.path.splitext(filepath)[0] + "_data_position.json"
+        self.shuffle_seed, self.initial_step, self.cur_step = shuffle_seed, 0, None
+        self.saved_position = {}
+        if os.path.exists(self.position_file):
+            with open(self.position_file, "r") as ff:
+                self.saved_position = json.load(ff)
+
+    def resume_step(self, initial_epoch):
+        """ Steps already trained in initial_epoch by the last run, 0 if it's not stopped in the middle of initial_epoch """
+        if self.saved_position.get("epoch", -1) == initial_epoch and self.saved_position.get("step", 0) > 0:
+            print(">>>> Resume data position from %s: %s" % (self.position_file, self.saved_position))
+            return self.saved_position["step"]
+        return 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.cur_step = self.initial_step + batch + 1
+        super(DataPositionCheckpoint, self).on_train_batch_end(batch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.cur_step = None
+        super(DataPositionCheckpoint, self).on_epoch_end(epoch, logs)
+
+    def _save_model(self, *args, **kwargs):
+        # Private ModelCheckpoint API, signature changes between TF versions, only epoch as the first argument is used
+        super(DataPositionCheckpoint, self)._save_model(*args, **kwargs)
+        epoch = kwargs["epoch"] if "epoch" in kwargs else args[0]
+        steps = self.initial_step + self.params["steps"] if self.params.get("steps") else None
+        if self.cur_step is None or self.cur_step == steps:
+            self.saved_position = {"epoch": epoch + 1, "step": 0, "shuffle_seed": self.shuffle_seed}
+        else:
+            self.saved_position = {"epoch": epoch, "step": self.cur_step, "shuffle_seed": self.shuffle_seed}
+        with open(self.position_file, "w") as ff:
+            json.dump(self.saved_position, ff)
+
+
 class ConstantDecayScheduler(keras.callbacks.Callback):
     def __init__(self, sch, lr_base=1e-1, decay_rate=0.1):
         super(ConstantDecayScheduler, self).__init__()
@@ -157,12 +218,13 @@ def scheduler(epoch, lr_base, decay_rate=0.05, lr_min=0, warmup=10):
     return lr
 
 
-def basic_callbacks(checkpoint="keras_checkpoints.h5", evals=[], lr=0.001, lr_decay=0.05, lr_min=0, lr_decay_steps=0):
+def basic_callbacks(checkpoint="keras_checkpoints.h5", evals=[], lr=0.001, lr_decay=0.05, lr_min=0, lr_decay_steps=0, save_freq="epoch"):
     checkpoint_base = "./checkpoints"
     if not os.path.exists(checkpoint_base):
         os.mkdir(checkpoint_base)
     checkpoint = os.path.join(checkpoint_base, checkpoint)
-    model_checkpoint = ModelCheckpoint(checkpoint, verbose=1)
+    # save_freq int value for also saving every [NUM] batches, with data position for resuming in the middle of an epoch
+    model_checkpoint = DataPositionCheckpoint(checkpoint, verbose=1, save_freq=save_freq)
     # model_checkpoint = keras.callbacks.experimental.BackupAndRestore(checkpoint_base)
 
     if isinstance(lr_decay_steps, list):
@@ -4,62 +4,147 @@ import sys
 import os
 
 
-def MXnet_record_to_folder(dataset_dir):
-    import os
+def __convert_records_chunk__(rec_path, save_dir, chunk_id, keys, image_starts, image_lens, image_classes):
+    """ Worker for MXnet_record_to_folder, writes one chunk of records, reading them sequentially """
+    with open(rec_path, "rb") as ff:
+        for key, start, length, label in zip(keys, image_starts, image_lens, image_classes):
+            ff.seek(start)
+            with open(os.path.join(save_dir, str(label), str(key) + ".jpg"), "wb") as gg:
+                gg.write(ff.read(length))
+    return chunk_id
+
+
+def MXnet_record_to_folder(dataset_dir, workers=None, chunk_size=10000):
+    """ Records are split into chunks of chunk_size, converted in a process pool, without mxnet.
+    Finished chunks are saved in a progress file in save_dir, so an interrupted conversion resumes from them.
+    """
+    import json
     import numpy as np
-    import mxnet as mx
     from tqdm import tqdm
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from data import MXnet_record_reader
 
     save_dir = (dataset_dir[:-1] if dataset_dir.endswith("/") else dataset_dir) + "_112x112_folders"
-    idx_path = os.path.join(dataset_dir, "train.idx")
-    bin_path = os.path.join(dataset_dir, "train.rec")
+    rec_path = os.path.join(dataset_dir, "train.rec")
+    progress_file = os.path.join(save_dir, "convert_progress.json")
 
-    print("save_dir = %s, idx_path = %s, bin_path = %s" % (save_dir, idx_path, bin_path))
-    if os.path.exists(save_dir):
+    print("save_dir = %s, rec_path = %s" % (save_dir, rec_path))
+    done_chunks = []
+    if os.path.exists(progress_file):
+        with open(progress_file, "r") as ff:
+            progress = json.load(ff)
+        chunk_size, done_chunks = progress["chunk_size"], progress["done_chunks"]
+        print(">>>> Resume converting, chunk_size: %d, finished chunks: %d" % (chunk_size, len(done_chunks)))
+    elif os.path.exists(save_dir):
         print("%s already exists." % save_dir)
         return
 
-    imgrec = mx.recordio.MXIndexedRecordIO(idx_path, bin_path, "r")
-    rec_header, _ = mx.recordio.unpack(imgrec.read_idx(0))
+    reader = MXnet_record_reader(dataset_dir)
+    total_chunks = int(np.ceil(len(reader) / chunk_size))
+    print(">>>> Images: %d, classes: %d, chunks: %d" % (len(reader), reader.classes, total_chunks))
+
+    def save_progress():
+        with open(progress_file + ".tmp", "w") as ff:
+            json.dump({"chunk_size": chunk_size, "done_chunks": done_chunks}, ff)
+        os.replace(progress_file + ".tmp", progress_file)
+
+    # Progress file first, so save_dir never exists without it, then create all class folders once
+    os.makedirs(save_dir, exist_ok=True)
+    save_progress()
+    for label in np.unique(reader.image_classes):
+        os.makedirs(os.path.join(save_dir, str(label)), exist_ok=True)
+    todo_chunks = sorted(set(range(total_chunks)) - set(done_chunks))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for chunk_id in todo_chunks:
+            ss = slice(chunk_id * chunk_size, (chunk_id + 1) * chunk_size)
+            chunk = (reader.keys[ss], reader.image_starts[ss], reader.image_lens[ss], reader.image_classes[ss])
+            futures.append(executor.submit(__convert_records_chunk__, rec_path, save_dir, chunk_id, *chunk))
+        for future in tqdm(as_completed(futures), "Converting chunks", total=len(futures)):
+            done_chunks.append(future.result())
+            save_progress()
+    os.remove(progress_file)
+
+
+def __is_complete_jpeg__(img):
+    """ JPEG SOI marker at start, and EOI marker at end, allowing trailing zero padding """
+    return img[:3] == b"\xff\xd8\xff" and img.rstrip(b"\x00").endswith(b"\xff\xd9")
 
-    for ii in tqdm(range(1, int(rec_header.label[0]))):
-        img_info = imgrec.read_idx(ii)
-        header, img = mx.recordio.unpack(img_info)
-        # img_idx = str(int(np.sum(header.label)))
-        img_idx = str(int(header.label if isinstance(header.label, float) else header.label[0]))
-        img_save_dir = os.path.join(save_dir, img_idx)
-        if not os.path.exists(img_save_dir):
-            os.makedirs(img_save_dir)
-        with open(os.path.join(img_save_dir, str(ii) + ".jpg"), "wb") as ff:
-            ff.write(img)
 
+def __to_jpeg_bytes__(img):
+    """ Original bytes if a complete JPEG, or decode and encode as JPEG for other formats / truncated ones.
+    Raises if not decodable, failing at converting time instead of later in eval_callback.
+    """
+    img = bytes(img)  # bytearray / numpy bytes are not compatible with tf.image.decode_jpeg
+    if __is_complete_jpeg__(img):
+        return img
 
-def MXnet_bin_files_to_tf(test_bins, limit=0):
     import io
-    import pickle
     import tensorflow as tf
     from skimage.io import imread
 
+    return tf.image.encode_jpeg(imread(io.BytesIO(img))).numpy()
+
+
+def MXnet_bin_files_to_tf(test_bins, limit=0, workers=8):
+    import pickle
+    from concurrent.futures import ThreadPoolExecutor
+
     print("test_bins =", test_bins)
     for test_bin_file in test_bins:
         with open(test_bin_file, "rb") as ff:
             bins, issame_list = pickle.load(ff, encoding="bytes")
 
-        bb = [tf.image.encode_jpeg(imread(io.BytesIO(ii))).numpy() for ii in bins[: limit * 2] + bins[-limit * 2 :]]
+        # Keep JPEG bytes as they are, only transcoding other formats in a thread pool
+        source = bins[: limit * 2] + bins[-limit * 2 :]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            bb = list(executor.map(__to_jpeg_bytes__, source))
+        print(">>>> Transcoded %d / %d non JPEG or truncated images" % (sum([not __is_complete_jpeg__(bytes(ii)) for ii in source]), len(bb)))
         print("Saving to %s" % test_bin_file)
         with open(test_bin_file, "wb") as ff:
             pickle.dump([bb, issame_list[:limit] + issame_list[-limit:]], ff)
 
 
+def MXnet_bin_files_to_decoded(test_bins, workers=8):
+    """ Decode bin files once to `{bin_name}_decoded` folders, holding uint8 memmap `images.npy` and `issame.npy`.
+    `evals.eval_callback` accepts these folders directly, skipping JPEG decoding on every evaluation.
+    """
+    import pickle
+    import numpy as np
+    import tensorflow as tf
+    from concurrent.futures import ThreadPoolExecutor
+
+    decode = lambda img: tf.image.decode_image(bytes(img), channels=3, expand_animations=False).numpy()
+    for test_bin_file in test_bins:
+        with open(test_bin_file, "rb") as ff:
+            bins, issame_list = pickle.load(ff, encoding="bytes")
+        save_dir = os.path.splitext(test_bin_file)[0] + "_decoded"
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            first = decode(bins[0])
+            images = np.lib.format.open_memmap(os.path.join(save_dir, "images.npy"), "w+", dtype="uint8", shape=(len(bins), *first.shape))
+            for id, img in enumerate(executor.map(decode, bins)):
+                images[id] = img
+            images.flush()
+        np.save(os.path.join(save_dir, "issame.npy"), np.array(issame_list, dtype="bool"))
+        print("Saved %s, images: %s" % (save_dir, images.shape))
+
+
 """ CUDA_VISIBLE_DEVICES='-1' ./prepare_data.py -D /datasets/faces_emore """
 """ CUDA_VISIBLE_DEVICES='-1' ./prepare_data.py -D /datasets/faces_emore -T lfw.bin cfp_fp.bin agedb_30.bin """
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-D", "--dataset_dir", type=str, required=True, help="MXnet record dataset directory")
     parser.add_argument("-T", "--test_bins", nargs="*", type=None, help="Test bin files in dataset_dir be converted")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Processes for converting dataset, default cpu count")
+    parser.add_argument("-P", "--decoded", action="store_true", help="Also decode test bin files to [bin_name]_decoded memmap folders")
 
     args = parser.parse_known_args(sys.argv[1:])[0]
     if args.test_bins != None and len(args.test_bins) != 0:
         args.test_bins = [os.path.join(args.dataset_dir, ii) for ii in args.test_bins]
         MXnet_bin_files_to_tf(args.test_bins)
-    MXnet_record_to_folder(args.dataset_dir)
+        if args.decoded:
+            MXnet_bin_files_to_decoded(args.test_bins)
+    MXnet_record_to_folder(args.dataset_dir, workers=args.workers)
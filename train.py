@@ -31,7 +31,10 @@ def print_buildin_models():
 
 
 # MXNET: bn_momentum=0.9, bn_epsilon=2e-5, TF default: bn_momentum=0.99, bn_epsilon=0.001
-def buildin_models(name, dropout=1, emb_shape=512, input_shape=(112, 112, 3), output_layer="GDC", bn_momentum=0.99, bn_epsilon=0.001, **kwargs):
+# uint8_input=True: model takes uint8 images, normalization `(xx - 127.5) * 0.0078125` is done by a `Rescaling` layer in model
+def buildin_models(
+    name, dropout=1, emb_shape=512, input_shape=(112, 112, 3), output_layer="GDC", bn_momentum=0.99, bn_epsilon=0.001, uint8_input=False, **kwargs
+):
     name = name.lower()
     """ Basic model """
     if name == "mobilenet":
@@ -108,8 +111,13 @@ def buildin_models(name, dropout=1, emb_shape=512, input_shape=(112, 112, 3), ou
         return None
     xx.trainable = True
 
-    inputs = xx.inputs[0]
-    nn = xx.outputs[0]
+    if uint8_input:
+        inputs = keras.layers.Input(input_shape, dtype="uint8")
+        nn = keras.layers.experimental.preprocessing.Rescaling(scale=1.0 / 128, offset=-127.5 / 128, name="normalize")(inputs)
+        nn = xx(nn)
+    else:
+        inputs = xx.inputs[0]
+        nn = xx.outputs[0]
 
     if output_layer == "E":
         """ Fully Connected """
@@ -148,7 +156,15 @@ def add_l2_regularizer_2_model(model, weight_decay, custom_objects={}, apply_to_
                     regularizers_type[layer.__class__.__name__] = rrs
         print(regularizers_type)
 
-    for layer in model.layers:
+    def flatten_layers(model):
+        # Backbone is a nested model if built with uint8_input=True
+        for layer in model.layers:
+            if isinstance(layer, keras.models.Model):
+                yield from flatten_layers(layer)
+            else:
+                yield layer
+
+    for layer in flatten_layers(model):
         attrs = []
         if isinstance(layer, keras.layers.Dense) or isinstance(layer, keras.layers.Conv2D):
             # print(">>>> Dense or Conv2D", layer.name, "use_bias:", layer.use_bias)
@@ -196,6 +212,8 @@ def replace_ReLU_with_PReLU(model):
         if isinstance(layer, keras.layers.ReLU):
             print(">>>> Convert ReLU:", layer.name)
             return keras.layers.PReLU(shared_axes=[1, 2], name=layer.name)
+        if isinstance(layer, keras.models.Model):
+            return keras.models.clone_model(layer, clone_function=convert_ReLU)
         return layer
 
     # model = keras.applications.MobileNet(include_top=False, input_shape=(112, 112, 3), weights=None)
@@ -262,7 +280,16 @@ class Train:
         lr_min=0,
         eval_freq=1,
         random_status=0,
-        dataset_cache=False,
+        dataset_cache=False,  # True or a path for caching decoded images in a memmap file
+        dataset_cache_max_gb=None,  # Size cap for dataset_cache, None for caching all images
+        data_service_workers=0,  # > 0 for decoding softmax dataset in [NUM] local worker processes by tf.data service
+        sampler="uniform",  # Softmax dataset sampler, "uniform" over images, or by class frequency "balanced" / "sqrt"
+        batch_augment=False,  # True for softmax dataset random augment on batches after batch, instead of on every image
+        sparse_label=False,  # True for int class id labels, need losses accepting sparse labels, like keras.losses.SparseCategoricalCrossentropy
+        shuffle_seed=None,  # Seed for dataset index permutations, None for the saved one in data position file, or a random one
+        save_freq="epoch",  # Checkpoint save frequency, int value for also saving every [NUM] batches, with data position for resuming
+        resume_data_position=None,  # Resume data position / shuffle_seed saved with checkpoint, None for only if model is the checkpoint file
+        async_eval=False,  # True for evaluating on a CPU replica of basic_model in a background thread, not blocking training
     ):
         custom_objects.update(
             {
@@ -329,52 +356,104 @@ class Train:
             self.batch_size = batch_size * strategy.num_replicas_in_sync
             print(">>>> num_replicas_in_sync: %d, batch_size: %d" % (strategy.num_replicas_in_sync, self.batch_size))
 
-        my_evals = [evals.eval_callback(self.basic_model, ii, batch_size=batch_size, eval_freq=eval_freq) for ii in eval_paths]
+        my_evals = [
+            evals.eval_callback(self.basic_model, ii, batch_size=batch_size, eval_freq=eval_freq, async_eval=async_eval) for ii in eval_paths
+        ]
         if len(my_evals) != 0:
             my_evals[-1].save_model = os.path.splitext(save_path)[0]
         basic_callbacks = myCallbacks.basic_callbacks(
-            checkpoint=save_path, evals=my_evals, lr=lr_base, lr_decay=lr_decay, lr_min=lr_min, lr_decay_steps=lr_decay_steps
+            checkpoint=save_path,
+            evals=my_evals,
+            lr=lr_base,
+            lr_decay=lr_decay,
+            lr_min=lr_min,
+            lr_decay_steps=lr_decay_steps,
+            save_freq=save_freq,
         )
         self.my_evals = my_evals
         self.basic_callbacks = basic_callbacks
         self.my_hist = [ii for ii in self.basic_callbacks if isinstance(ii, myCallbacks.My_history)][0]
+        self.data_position = [ii for ii in self.basic_callbacks if isinstance(ii, myCallbacks.DataPositionCheckpoint)][0]
+        if resume_data_position is None:
+            # A fresh run reusing the same save_path should not skip batches by the last run position
+            is_checkpoint_model = isinstance(model, str) and os.path.abspath(model) == os.path.abspath(self.data_position.filepath)
+            resume_data_position = is_checkpoint_model
+        if not resume_data_position:
+            self.data_position.saved_position = {}
         self.custom_callbacks = []
 
-        self.data_path, self.random_status, self.dataset_cache = data_path, random_status, dataset_cache
+        self.data_path, self.random_status, self.dataset_cache, self.sparse_label = data_path, random_status, dataset_cache, sparse_label
+        self.dataset_cache_max_gb, self.data_service_workers, self.sampler = dataset_cache_max_gb, data_service_workers, sampler
+        self.batch_augment = batch_augment
         self.train_ds, self.steps_per_epoch, self.classes, self.is_triplet_dataset = None, None, 0, False
+        # Fixed for all train_schedule, so dataset rebuilt for a later initial_epoch continues the same permutations
+        if shuffle_seed is None:
+            shuffle_seed = self.data_position.saved_position.get("shuffle_seed", None)
+        self.shuffle_seed = np.random.randint(0, 2 ** 31) if shuffle_seed is None else shuffle_seed
+        self.data_position.shuffle_seed = self.shuffle_seed
+        self.dataset_initial_epoch, self.dataset_initial_step = 0, 0
         self.default_optimizer = "adam"
         self.metrics = ["accuracy"]
         self.is_distiller = False
+        # Model built with uint8_input=True does normalization itself, dataset keeps images in uint8
+        self.is_uint8_input = self.basic_model.inputs[0].dtype == tf.uint8
 
     def __search_embedding_layer__(self, model):
         for ii in range(1, 6):
             if model.layers[-ii].name == "embedding":
                 return -ii
 
-    def __init_dataset_triplet__(self):
-        if self.train_ds == None or self.is_triplet_dataset == False:
+    def __init_dataset_triplet__(self, initial_epoch=0, initial_step=0):
+        # Triplet dataset is also an infinite stream starting from its initial_epoch / initial_step
+        is_position_changed = (initial_epoch, initial_step) != (self.dataset_initial_epoch, self.dataset_initial_step)
+        if self.train_ds == None or self.is_triplet_dataset == False or is_position_changed:
             print(">>>> Init triplet dataset...")
             # batch_size = int(self.batch_size / 4 * 1.5)
             batch_size = self.batch_size // 4
-            tt = data.Triplet_dataset(self.data_path, batch_size=batch_size, random_status=self.random_status, random_crop=(100, 100, 3))
+            tt = data.Triplet_dataset(
+                self.data_path,
+                batch_size=batch_size,
+                random_status=self.random_status,
+                random_crop=(100, 100, 3),
+                sparse_label=self.sparse_label,
+                keep_uint8=self.is_uint8_input,
+                shuffle_seed=self.shuffle_seed,
+                initial_epoch=initial_epoch,
+                initial_step=initial_step,
+            )
             self.train_ds = tt.train_dataset
-            self.classes = self.train_ds.element_spec[-1].shape[-1]
+            self.steps_per_epoch = tt.steps_per_epoch
+            self.dataset_initial_epoch, self.dataset_initial_step = initial_epoch, initial_step
+            self.classes = tt.classes
             self.is_triplet_dataset = True
 
-    def __init_dataset_softmax__(self):
-        if self.train_ds == None or self.is_triplet_dataset == True:
+    def __init_dataset_softmax__(self, initial_epoch=0, initial_step=0):
+        # Softmax dataset is an infinite stream starting from its initial_epoch / initial_step, rebuild it for a different one
+        cur_position = (self.dataset_initial_epoch, self.dataset_initial_step)
+        is_position_changed = self.steps_per_epoch is not None and (initial_epoch, initial_step) != cur_position
+        if self.train_ds == None or self.is_triplet_dataset == True or is_position_changed:
             print(">>>> Init softmax dataset...")
             self.train_ds = data.prepare_dataset(
-                self.data_path, batch_size=self.batch_size, random_status=self.random_status, random_crop=(100, 100, 3), cache=self.dataset_cache,
+                self.data_path,
+                batch_size=self.batch_size,
+                random_status=self.random_status,
+                random_crop=(100, 100, 3),
+                cache=self.dataset_cache,
+                cache_max_gb=self.dataset_cache_max_gb,
+                sparse_label=self.sparse_label,
+                batch_augment=self.batch_augment,
+                keep_uint8=self.is_uint8_input,
+                shuffle_seed=self.shuffle_seed,
+                initial_epoch=initial_epoch,
+                initial_step=initial_step,
+                data_service_workers=self.data_service_workers,
+                sampler=self.sampler,
             )
-            label_spec = self.train_ds.element_spec[-1]
-            if isinstance(label_spec, tuple):
-                # dataset with embedding values
-                self.is_distiller = True
-                self.classes = label_spec[0].shape[-1]
-            else:
-                self.is_distiller = False
-                self.classes = label_spec.shape[-1]
+            # dataset with embedding values if label_spec is a tuple
+            self.is_distiller = isinstance(self.train_ds.element_spec[-1], tuple)
+            self.classes = self.train_ds.classes
+            self.steps_per_epoch = self.train_ds.steps_per_epoch
+            self.dataset_initial_epoch, self.dataset_initial_step = initial_epoch, initial_step
             self.is_triplet_dataset = False
 
     def __init_optimizer__(self, optimizer):
@@ -465,15 +544,31 @@ class Train:
                 return self.softmax
         return self.softmax
 
-    def __basic_train__(self, loss, epochs, initial_epoch=0, loss_weights=None):
+    def __basic_train__(self, loss, epochs, initial_epoch=0, loss_weights=None, initial_step=0):
         self.model.compile(optimizer=self.optimizer, loss=loss, metrics=self.metrics, loss_weights=loss_weights)
+        if initial_step > 0 and self.steps_per_epoch is not None:
+            # Finish the interrupted epoch first, with dataset starting from the exact sample
+            print(">>>> Resume epoch %d from step %d / %d" % (initial_epoch + 1, initial_step, self.steps_per_epoch))
+            self.data_position.initial_step = initial_step
+            self.__fit__(initial_epoch + 1, initial_epoch, self.steps_per_epoch - initial_step)
+            self.data_position.initial_step = 0
+            initial_epoch += 1
+            if self.model.stop_training or initial_epoch >= epochs:
+                return
+            if self.is_triplet_dataset:
+                self.__init_dataset_triplet__(initial_epoch)
+            else:
+                self.__init_dataset_softmax__(initial_epoch)
+        self.__fit__(epochs, initial_epoch, self.steps_per_epoch)
+
+    def __fit__(self, epochs, initial_epoch, steps_per_epoch):
         self.model.fit(
             self.train_ds,
             epochs=epochs,
             verbose=1,
             callbacks=self.callbacks,
             initial_epoch=initial_epoch,
-            steps_per_epoch=self.steps_per_epoch,
+            steps_per_epoch=steps_per_epoch,
             use_multiprocessing=True,
             workers=4,
         )
@@ -485,6 +580,8 @@ class Train:
 
     def train(self, train_schedule, initial_epoch=0):
         train_schedule = [train_schedule] if isinstance(train_schedule, dict) else train_schedule
+        # Last run saved with save_freq stopped in the middle of initial_epoch, resume from the exact sample
+        initial_step = self.data_position.resume_step(initial_epoch)
         for sch in train_schedule:
             if sch.get("loss", None) is None:
                 continue
@@ -492,10 +589,12 @@ class Train:
             type = sch.get("type", None) or self.__init_type_by_loss__(cur_loss)
             print(">>>> Train %s..." % type)
 
+            is_bottleneck_only = sch.get("bottleneckOnly", False)
+            dataset_epoch, dataset_step = (0, 0) if is_bottleneck_only else (initial_epoch, initial_step)
             if sch.get("triplet", False) or sch.get("tripletAll", False) or type == self.triplet:
-                self.__init_dataset_triplet__()
+                self.__init_dataset_triplet__(dataset_epoch, dataset_step)
             else:
-                self.__init_dataset_softmax__()
+                self.__init_dataset_softmax__(dataset_epoch, dataset_step)
 
             self.basic_model.trainable = True
             self.__init_optimizer__(sch.get("optimizer", None))
@@ -560,8 +659,9 @@ class Train:
                 self.__basic_train__(cur_loss, sch["epoch"], initial_epoch=0, loss_weights=loss_weights)
                 self.basic_model.trainable = True
             else:
-                self.__basic_train__(cur_loss, initial_epoch + sch["epoch"], initial_epoch=initial_epoch, loss_weights=loss_weights)
-                initial_epoch += sch["epoch"]
+                epochs = initial_epoch + sch["epoch"]
+                self.__basic_train__(cur_loss, epochs, initial_epoch=initial_epoch, loss_weights=loss_weights, initial_step=initial_step)
+                initial_epoch, initial_step = epochs, 0
 
             print(">>>> Train %s DONE!!! epochs = %s, model.stop_training = %s" % (type, self.model.history.epoch, self.model.stop_training))
             print(">>>> My history:")
@@ -13,6 +13,7 @@ from sklearn.preprocessing import normalize
 from skimage.io import imread
 from skimage import transform
 from tqdm import tqdm
+from data import keras_model_infer
 
 
 def init_det_and_emb_model(model_file):
@@ -73,8 +74,8 @@ def embedding_images(det, face_model, known_user, batch_size=32, force_reload=Fa
 
         """ Extract embedding info from aligned face images """
         steps = int(np.ceil(len(image_classes) / batch_size))
-        nimgs = (np.array(nimgs) - 127.5) * 0.0078125
-        embeddings = [face_model(nimgs[ii * batch_size : (ii + 1) * batch_size]) for ii in tqdm(range(steps), "Embedding")]
+        nimgs, infer = np.array(nimgs), keras_model_infer(face_model)
+        embeddings = [infer(nimgs[ii * batch_size : (ii + 1) * batch_size]) for ii in tqdm(range(steps), "Embedding")]
 
         embeddings = normalize(np.concatenate(embeddings, axis=0))
         image_classes = np.array(image_classes)
@@ -93,7 +94,7 @@ def image_recognize(image_classes, embeddings, det, face_model, frame, image_for
     if len(bbs) == 0:
         return [], [], [], []
 
-    emb_unk = face_model((nimgs - 127.5) * 0.0078125).numpy()
+    emb_unk = keras_model_infer(face_model)(nimgs)
     emb_unk = normalize(emb_unk)
     dists = np.dot(embeddings, emb_unk.T).T
     rec_idx = dists.argmax(-1)